@@ -11,9 +11,14 @@ from PyQt4.QtGui import *
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.pyplot import *
 from matplotlib.widgets import RectangleSelector
-from numpy import log10
-
-from fractal_qt4_mpl_lib import mandelbrot
+from matplotlib import cm
+from numpy import log10, floor, linspace, intp, uint8
+from decimal import Decimal, DefaultContext, getcontext
+from threading import Event
+from os.path import expanduser
+
+from fractal_qt4_mpl_lib import mandelbrot_progressive, mandelbrot_tiled, mandelbrot_resume, tile_cache, \
+    disk_cache, auto_iter
 from gtk._gtk import Alignment
 
 
@@ -24,12 +29,84 @@ im_min = 0.135
 im_max = 0.145
 
 max_betr = 2
-max_iter = 100
+max_iter = 100  # Or "auto" to choose it from the escape rate
 res = 400       # X Resolution
 cont = True     # Show continual color
 norm = True     # Normalize Values
+workers = None  # Render processes (None: one per cpu core)
+precision = "auto"  # "single", "double", "dd", "perturb" or "auto" by zoom depth
+cache_size = 256*2**20  # Bytes of calculated tiles kept for pan and zoom
+disk_path = expanduser("~/.cache/pyMandelBrot")  # Images kept between sessions (None: off)
+disk_size = 2**30       # Bytes of images kept on disk
+colormap = 'jet'        # Matplotlib colormap of the palette
 ######################
 
+# Digits of the viewport coordinates, new threads start from DefaultContext
+getcontext().prec = 50
+DefaultContext.prec = 50
+
+#
+# Palette of <n> uint8 RGB colors from the matplotlib colormap <name>
+#
+palettes = {}
+def palette(name, n=1024):
+    if (name, n) not in palettes:
+        rgba = cm.get_cmap(name)(linspace(0, 1, n))
+        palettes[name, n] = (rgba[:, :3] * 255).round().astype(uint8)
+    return palettes[name, n]
+
+#
+# Colors the values of data from their minimum to maximum with the palette lut
+#
+def colorize(data, lut):
+    lo, hi = data.min(), data.max()
+    scale = (len(lut) - 1) / float(hi - lo) if hi > lo else 0
+    return lut.take(((data - lo) * scale).astype(intp), axis=0)
+
+#
+# Calculates the images of one draw in the background. The previews and the
+# final image are sent with the signal rendered((draw_id, fractal, final)),
+# setting self.cancel stops the calculation after the current tile.
+#
+class RenderThread(QThread):
+    def __init__(self, draw_id, args, cache, disk, prev, resume, parent=None):
+        QThread.__init__(self, parent)
+        self.draw_id = draw_id
+        self.args = args
+        self.cache = cache
+        self.disk = disk
+        self.prev = prev
+        self.resume = resume
+        self.cancel = Event()
+
+    def run(self):
+        args, cancel = self.args, self.cancel
+        fractal = None
+        if args[5] == "auto":
+            # Probe once for the previews and the tiles
+            n = auto_iter(*args[:5] + (args[6], precision), cancel=cancel)
+            if n is None:
+                return
+            args = args[:5] + (n,) + args[6:]
+        if self.resume:
+            # Only max_iter was raised, iterate the points still alive further
+            fractal = mandelbrot_resume(self.prev, args[5], cancel=cancel)
+        else:
+            # Take the image from the tile or disk cache
+            fractal = mandelbrot_tiled(*args, cache=self.cache, compute=False, precision=precision,
+                                       keep_state=True, keep_mag2=True, disk=self.disk)
+        if fractal is None and not cancel.is_set():
+            # Show coarse previews while the tiles are calculated
+            for preview in mandelbrot_progressive(*args, workers=workers, precision=precision,
+                                                  levels=(8, 4), cancel=cancel, keep_mag2=True):
+                self.emit(SIGNAL("rendered(PyQt_PyObject)"), (self.draw_id, preview, False))
+            # After a zoom out the pixels of the last image are on the new grid
+            fractal = mandelbrot_tiled(*args, cache=self.cache, workers=workers, precision=precision,
+                                       keep_state=True, prev=self.prev, cancel=cancel, keep_mag2=True,
+                                       disk=self.disk)
+        if fractal is not None and not cancel.is_set():
+            self.emit(SIGNAL("rendered(PyQt_PyObject)"), (self.draw_id, fractal, True))
+
 class AppForm(QMainWindow):
     def __init__(self, parent=None):
         QMainWindow.__init__(self, parent)
@@ -53,6 +130,18 @@ class AppForm(QMainWindow):
         #
         self.setMinimumWidth(620)
         self.resize(620, 460)
+        self.draw_id = 0
+        self.cache = tile_cache(cache_size)
+        self.disk = disk_cache(disk_path, disk_size) if disk_path else None
+        # Last image and the (viewport, max_iter) it was finished for
+        self.fractal = None
+        self.drawn = None
+        # Render thread of the newest draw and the cancelled ones still running,
+        # they are kept until they finish so Qt doesn't destroy them running
+        self.thread = None
+        self.stopped = []
+        # Image artist of the plot, updated for every image
+        self.image = None
         self.draw()
 
     def save_plot(self):
@@ -78,6 +167,7 @@ class AppForm(QMainWindow):
      * Save the plot to a file using the File menu
      * De-/activate continuous color spectrum
      * De-/activate normalized values
+     * Enter auto as Max Iter. to choose it from the escape rate
 
      ### Used Libraries ###
      * PyQt4
@@ -105,107 +195,173 @@ class AppForm(QMainWindow):
         """ Redraws the figure
         """
         # Grap values from textboxes
-        re_min = float(unicode(self.textbox_re_min.text()))
-        re_max = float(unicode(self.textbox_re_max.text()))
-        im_min = float(unicode(self.textbox_im_min.text()))
-        im_max = float(unicode(self.textbox_im_max.text()))
-        max_iter = int(unicode(self.textbox_max_iter.text()))
+        coord = self.get_coord()
+        re_min, re_max, im_min, im_max = coord
+        max_iter = unicode(self.textbox_max_iter.text()).strip()
+        max_iter = "auto" if max_iter == "auto" else int(max_iter)
+
+        # Nothing to calculate, only the checkboxes may have changed
+        if self.drawn == (coord, max_iter):
+            self.update_view()
+            return
+
+        # Deep views can't be resolved by float axes, show them relative to ReMin and ImMin
+        origin = (Decimal(0), Decimal(0))
+        if re_max - re_min < Decimal("1e-12") * max(abs(re_min), abs(im_min)):
+            origin = (re_min, im_min)
+
+        # Stop the calculation of the last draw, its results are dropped
+        self.stop_thread()
+
+        self.draw_id += 1
+        self.view = (coord, origin)
+        self.request = (coord, max_iter)
+        # Iteration values are calculated, continuous coloring is derived from mag2
+        args = (re_min, re_max, im_min, im_max, max_betr, max_iter, res, False)
+        prev = self.fractal
+        resume = (self.drawn is not None and self.drawn[0] == coord and prev.state is not None
+                  and max_iter != "auto" and max_iter > prev.state['iter'])
+
+        self.status_text.setText("Calculating...")
+        self.thread = RenderThread(self.draw_id, args, self.cache, self.disk, prev, resume)
+        self.connect(self.thread, SIGNAL("rendered(PyQt_PyObject)"), self.on_rendered)
+        self.thread.start()
+
+    #
+    # Shows an image of the render thread, unless a newer draw was started
+    #
+    def on_rendered(self, result):
+        draw_id, fractal, final = result
+        if draw_id != self.draw_id:
+            return
+        self.fractal = fractal
+        if final:
+            self.drawn = self.request
+        self.update_view()
+
+    #
+    # Shows self.fractal again with the current checkboxes and palette,
+    # nothing is calculated
+    #
+    def update_view(self):
+        if self.fractal is None:
+            return
+        coord, origin = self.view
+        self.show_fractal(coord, origin)
+
+        # Align layout and redraw plot
+        self.canvas.draw_idle()
+        #self.fig.tight_layout()
 
-        # Grap values from checkboxes
-        self.axes.grid(self.grid_cb.isChecked())
-        cont = self.cont_cb.isChecked()
-        norm = self.norm_cb.isChecked()
+    #
+    # Cancels the render thread without waiting for it, it stops at its next
+    # check and its results are dropped by on_rendered
+    #
+    def stop_thread(self):
+        self.stopped = [t for t in self.stopped if t.isRunning()]
+        if self.thread is not None:
+            self.thread.cancel.set()
+            self.stopped.append(self.thread)
+            self.thread = None
+
+    def closeEvent(self, event):
+        self.stop_thread()
+        for t in self.stopped:
+            t.wait()
+        QMainWindow.closeEvent(self, event)
 
-        # Calculate mandelbrot set
-        self.fractal = mandelbrot(re_min, re_max, im_min, im_max, max_betr, max_iter, res, cont)
+    #
+    # Load self.fractal to the mpl plot, limited to the viewport coord. The
+    # checkboxes only change how it is shown, self.fractal itself isn't changed.
+    #
+    def show_fractal(self, coord, origin):
+        re_min, re_max, im_min, im_max = coord
+        re_0, im_0 = origin
+
+        # Continuous or iteration values
+        data = self.fractal.values(self.cont_cb.isChecked())
 
         # Normalize Values
-        if norm:
-            self.fractal.data[self.fractal.data > 0] -= self.fractal.min
+        if self.norm_cb.isChecked():
+            esc = data > 0
+            if esc.any():
+                data = data.copy()
+                data[esc] -= data[esc].min()
 
         # Show calculation time in statusbar
-        self.status_text.setText("Calculation Time: %0.3fs" % self.fractal.calc_time)
-
-        # Load data to mpl plot
-        self.axes.imshow(self.fractal.data.T, origin="lower left", cmap='jet', extent=[re_min, re_max, im_min, im_max])
-        self.axes.set_xlabel("Re(c)", labelpad=20)
-        self.axes.set_ylabel("Im(c)")
+        self.status_text.setText("Calculation Time: %0.3fs, Max Iter.: %d"
+                                 % (self.fractal.calc_time, self.fractal.max_iter))
+
+        # Tiled images can be a bit bigger than the viewport
+        e = [Decimal(v) for v in self.fractal.extent]
+        extent = [float(e[0] - re_0), float(e[1] - re_0), float(e[2] - im_0), float(e[3] - im_0)]
+        rgb = colorize(data, palette(colormap)).transpose(1, 0, 2)
+        if self.image is None:
+            self.image = self.axes.imshow(rgb, origin="lower left", extent=extent)
+        else:
+            self.image.set_data(rgb)
+            self.image.set_extent(extent)
+        self.axes.set_xlim(float(re_min - re_0), float(re_max - re_0))
+        self.axes.set_ylim(float(im_min - im_0), float(im_max - im_0))
+        self.axes.set_xlabel("Re(c)" if re_0 == 0 else "Re(c) - %s" % re_0, labelpad=20)
+        self.axes.set_ylabel("Im(c)" if im_0 == 0 else "Im(c) - %s" % im_0)
 
         # Show/hide grid
         if self.grid_cb.isChecked():
             self.axes.grid(linewidth=1, linestyle='-')
-        # Align layout and redraw plot
-        self.canvas.draw_idle()
-        #self.fig.tight_layout()
+        else:
+            self.axes.grid(False)
+
+    #
+    # Read the viewport from the textboxes as Decimals
+    #
+    def get_coord(self):
+        return [Decimal(unicode(t.text())) for t in (self.textbox_re_min, self.textbox_re_max,
+                                                     self.textbox_im_min, self.textbox_im_max)]
+
+    #
+    # Write the viewport to the textboxes, rounded to a hundredth of a pixel
+    #
+    def set_coord(self, re_min, re_max, im_min, im_max):
+        q = Decimal(1).scaleb(int(floor(log10(float(re_max - re_min) / res))) - 2)
+        for t, v in zip((self.textbox_re_min, self.textbox_re_max, self.textbox_im_min,
+                         self.textbox_im_max), (re_min, re_max, im_min, im_max)):
+            t.setText(str(v.quantize(q)))
+
+    #
+    # Position of a mouse event relative to the axes (0..1)
+    #
+    def axes_fraction(self, event):
+        x, y = self.axes.transAxes.inverted().transform((event.x, event.y))
+        return Decimal(float(x)), Decimal(float(y))
 
     def line_select_callback(self, eclick, erelease):
         # eclick and erelease are the press and release events
-        x1, y1 = eclick.xdata, eclick.ydata
-        x2, y2 = erelease.xdata, erelease.ydata
+        re_min, re_max, im_min, im_max = self.get_coord()
+        w, h = re_max - re_min, im_max - im_min
 
         # Zoom with left mouse click
         if eclick.button == 1:
             # Check for valid coordinates
-            if (x1 != None and y2 != None and x1 != None and y1 != None):
-                self.xmin = min(x1, x2)
-                self.xmax = max(x1, x2)
-                self.ymin = min(y1, y2)
-                self.ymax = max(y1, y2)
-                # Save array with relative values
-                self.xy = [self.xmax - self.xmin, self.ymax - self.ymin]
-
-                # Calculate precision in decimal digits
-                for v in self.xy:
-                    if v <= 1:
-                        self.decimals = round(log10(1 / v)) + 2
-
-                # Round values with calculated precision
-                re_min = round(self.xmin, int(self.decimals))
-                re_max = round(self.xmax, int(self.decimals))
-                im_min = round(self.ymin, int(self.decimals))
-                im_max = round(self.ymax, int(self.decimals))
-
-                # Update textbos values
-                self.textbox_re_min.setText(str(re_min))
-                self.textbox_re_max.setText(str(re_max))
-                self.textbox_im_min.setText(str(im_min))
-                self.textbox_im_max.setText(str(im_max))
-
-                # Calculate and draw new mandelbrot set
-                self.draw()
+            if None in (eclick.xdata, eclick.ydata, erelease.xdata, erelease.ydata):
+                return
+            x1, y1 = self.axes_fraction(eclick)
+            x2, y2 = self.axes_fraction(erelease)
+            if x1 == x2 or y1 == y2:
+                return
+
+            # Calculate the new values relative to the current viewport, so no
+            # precision is lost with float mouse coordinates
+            self.set_coord(re_min + min(x1, x2)*w, re_min + max(x1, x2)*w,
+                           im_min + min(y1, y2)*h, im_min + max(y1, y2)*h)
+
+            # Calculate and draw new mandelbrot set
+            self.draw()
 
         # Zoom with right mouse click
         if eclick.button == 3:
-            # Grap values from textboxes
-            re_min = float(unicode(self.textbox_re_min.text()))
-            re_max = float(unicode(self.textbox_re_max.text()))
-            im_min = float(unicode(self.textbox_im_min.text()))
-            im_max = float(unicode(self.textbox_im_max.text()))
-
-            self.xy = [ re_max - re_min, im_max - im_min]
-
             # Calculate new values
-            re_min = re_min - self.xy[0] / 2
-            re_max = re_max + self.xy[0] / 2
-            im_min = im_min - self.xy[1] / 2
-            im_max = im_max + self.xy[1] / 2
-
-            # Calculate precision in decimal digits
-            for v in self.xy:
-                if v <= 1:
-                    self.decimals = round(log10(1 / v)) + 2
-
-            # Round values with calculated precision
-            re_min = round(re_min, int(self.decimals))
-            re_max = round(re_max, int(self.decimals))
-            im_min = round(im_min, int(self.decimals))
-            im_max = round(im_max, int(self.decimals))
-
-            # Update textbos values
-            self.textbox_re_min.setText(str(re_min))
-            self.textbox_re_max.setText(str(re_max))
-            self.textbox_im_min.setText(str(im_min))
-            self.textbox_im_max.setText(str(im_max))
+            self.set_coord(re_min - w/2, re_max + w/2, im_min - h/2, im_max + h/2)
 
             # Calculate and draw new mandelbrot set
             self.draw()
@@ -264,6 +420,10 @@ class AppForm(QMainWindow):
         self.draw_button = QPushButton("Calculate && Draw")
         self.connect(self.draw_button, SIGNAL('clicked()'), self.draw)
 
+        # The checkboxes only change the presentation of the image
+        for cb in (self.grid_cb, self.cont_cb, self.norm_cb):
+            self.connect(cb, SIGNAL('stateChanged(int)'), self.update_view)
+
         #
         # Layout with box sizers
         #
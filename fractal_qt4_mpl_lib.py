@@ -6,57 +6,2356 @@
 @brief Calculates Mandelbrot set
 '''
 
+from __future__ import print_function
+import os
 import time
+import math
+import json
+import hashlib
+import tempfile
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
+from decimal import Decimal, localcontext
 import numpy as np
 
+# Optional kernel backends, see _backends
+try:
+    import numba
+except ImportError:
+    numba = None
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 class fractal_data():
-        def __init__(self, data, calc_t, shape=(400,400), datatype=np.int):
-            self.data = np.zeros(shape, dtype = datatype)
+        def __init__(self, data, calc_t, shape=(400,400), datatype=int, stats=None):
             self.data = data
             self.calc_time = calc_t
-            self.max = np.amax(data)
-            self.min = np.min(data[data>0])
+            # escape_stats of the values >0 as accumulated by the engine, if
+            # not given they are calculated from data when first used
+            if stats is not None:
+                self.stats = stats
+            # Viewport (re_min, re_max, im_min, im_max) of the image
+            self.extent = None
+            # Arithmetic the image was calculated with
+            self.precision = "double"
+            # Iteration limit of the image, the one chosen for max_iter="auto"
+            self.max_iter = None
+            # Number of points classified as interior by the periodicity check
+            self.periodic = 0
+            # Perturbation engine: reference orbits used, iterations skipped by
+            # the series approximation and points left glitched
+            self.references = 0
+            self.skipped = 0
+            self.glitched = 0
+            # Iteration state of the points still alive for mandelbrot_resume()
+            self.state = None
+            # Render options the image was calculated with, None for previews
+            self.opts = None
+            # False if the calculation was stopped early, the missing pixels are -1
+            self.complete = True
+            # Whether data has continuous values and, if kept, |z|^2 of the
+            # points at their escape (0 for points which didn't escape)
+            self.cont = False
+            self.mag2 = None
+            # Distance estimate of the escaped points to the set in pixels,
+            # 0 for the other points
+            self.de = None
+
+        #
+        # Maximum and minimum value >0 from the escape_stats, which are only
+        # calculated from data if the engine didn't accumulate them
+        #
+        def __getattr__(self, name):
+            if name == 'stats':
+                self.stats = _stats(np.asarray(self.data).ravel())
+                self.stats.periodic = self.periodic
+                return self.stats
+            if name == 'max':
+                return self.stats.max
+            if name == 'min':
+                return self.stats.min or 0
+            raise AttributeError(name)
+
+        #
+        # Escape values with or without continuous coloring, the other kind
+        # is derived from mag2 without iterating again
+        #
+        def values(self, cont):
+            if cont == self.cont or self.mag2 is None:
+                return self.data
+            v = np.array(self.data)
+            esc = self.mag2 > 0
+            if cont:
+                v[esc] = _escape_value(v[esc], self.mag2[esc], True)
+            else:
+                v[esc] = _escape_iter(v[esc], self.mag2[esc])
+            return v
 
         def info(self):
-            print "Data Shape: " + str(self.data.shape)
-            print "Calculation Time: %.3fs" % self.calc_time
-            print "Maximum Value: %d" % self.max
-            print "Minimum Value >0: %d" % self.min
+            print("Data Shape: " + str(self.data.shape))
+            print("Calculation Time: %.3fs" % self.calc_time)
+            print("Precision: %s" % self.precision)
+            print("Iterations: %d" % self.max_iter)
+            print("Maximum Value: %d" % self.max)
+            print("Minimum Value >0: %d" % self.min)
+            print("Escaped Points: %d" % self.stats.count)
+            print("Periodic Points: %d" % self.periodic)
+
+#
+# Statistics of the escape values >0 of a calculation: their number, maximum,
+# minimum and the histogram of their integer part (the escape iteration unless
+# continuous), plus the points found periodic. They are accumulated from the
+# escape events and merged with + across blocks, tiles and bands.
+#
+class escape_stats():
+        def __init__(self, count=0, vmax=0, vmin=None, hist=None, periodic=0):
+            self.count = count
+            self.max = vmax
+            # None while no value >0 was seen
+            self.min = vmin
+            self.hist = np.zeros(0, dtype=np.int64) if hist is None else hist
+            # Number of points classified as interior by the periodicity check
+            self.periodic = periodic
+
+        def __add__(self, other):
+            n = max(len(self.hist), len(other.hist))
+            hist = np.zeros(n, dtype=np.int64)
+            hist[:len(self.hist)] += self.hist
+            hist[:len(other.hist)] += other.hist
+            vmin = [v for v in (self.min, other.min) if v is not None]
+            return escape_stats(self.count + other.count, max(self.max, other.max),
+                                min(vmin) if vmin else None, hist, self.periodic + other.periodic)
+
+#
+# escape_stats of the escape values v, values <=0 (not escaped or not
+# calculated) are left out
+#
+def _stats(v):
+    v = v[v > 0]
+    if not len(v):
+        return escape_stats()
+    return escape_stats(len(v), v.max(), v.min(), np.bincount(v.astype(np.int64)))
+
+#
+# Pixel axes of the viewport, Re(c) along the first and Im(c) along the second axis
+#
+def _axes(re_min, re_max, im_min, im_max, res):
+    pix_y = int(round(res / (re_max - re_min) * (im_max - im_min)))
+    pix_x = res
+    x = np.linspace(re_min, re_max, pix_x)
+    y = np.linspace(im_min, im_max, pix_y)
+    return x, y
+
+#
+# Split a Decimal into a double-double (hi, lo) with hi + lo = v
+#
+def _split(v):
+    hi = float(v)
+    return hi, float(v - Decimal(hi))
+
+#
+# Pixel axes as double-doubles, the rows of x and y are the hi and lo parts.
+# The coordinates may be given as strings or Decimals.
+#
+def _axes_dd(re_min, re_max, im_min, im_max, res):
+    re_min, re_max, im_min, im_max = [Decimal(v) for v in (re_min, re_max, im_min, im_max)]
+    pix_y = int(round(res / float(re_max - re_min) * float(im_max - im_min)))
+    pix_x = res
+    with localcontext() as ctx:
+        ctx.prec = 40
+        x = [_split(re_min + k*(re_max - re_min)/(pix_x-1)) for k in range(pix_x)]
+        y = [_split(im_min + k*(im_max - im_min)/(pix_y-1)) for k in range(pix_y)]
+    return np.array(x).T, np.array(y).T
+
+#
+# Split a pix_x * pix_y grid into tiles of (x0, x1, y0, y1)
+#
+def _tiles(pix_x, pix_y, tile):
+    return [(x0, min(x0+tile, pix_x), y0, min(y0+tile, pix_y))
+            for x0 in range(0, pix_x, tile) for y0 in range(0, pix_y, tile)]
+
+#
+# One iteration z = z^2 + c on split real and imaginary buffers, t1 and t2 are scratch
+#
+def _step(zr, zi, cr, ci, t1, t2):
+    np.multiply(zr, zi, t1)
+    np.multiply(zr, zr, zr)
+    np.multiply(zi, zi, t2)
+    np.subtract(zr, t2, zr)
+    np.add(zr, cr, zr)
+    np.add(t1, t1, zi)
+    np.add(zi, ci, zi)
+
+#
+# _step with numexpr in two passes over the buffers and a copy instead of seven.
+# The operations are those of _step in the same order, so the results are equal.
+#
+def _step_numexpr(zr, zi, cr, ci, t1, t2):
+    numexpr.evaluate("zr*zi + zr*zi + ci", out=t1)
+    numexpr.evaluate("zr*zr - zi*zi + cr", out=zr)
+    zi[:] = t1
+
+#
+# Escape value of points which escaped after <it> iterations with |z|^2 = mag2
+#
+def _escape_value(it, mag2, cont):
+    if cont: return it - np.log( np.log(np.sqrt(mag2)) / 2 / np.log(2) ) / np.log(2)
+    return it
+
+#
+# Iterations of the continuous escape values v of points with |z|^2 = mag2
+#
+def _escape_iter(v, mag2):
+    return np.round(v + np.log( np.log(np.sqrt(mag2)) / 2 / np.log(2) ) / np.log(2))
+
+#
+# Saves the escape values of the points j in out, with a second row in out
+# (see _layers) their |z|^2 goes to out[1]
+#
+def _save_escape(out, j, it, mag2, cont):
+    if out.ndim > 1:
+        out[1, j] = mag2
+        out = out[0]
+    out[j] = _escape_value(it, mag2, cont)
+
+#
+# Saves the escape events (index, iteration, |z|^2) collected during a
+# calculation in out, the escape values are calculated once for all of them.
+# Returns their escape_stats.
+#
+def _save_escapes(out, events, cont):
+    if not events:
+        return escape_stats()
+    j, it, mag2 = [np.concatenate(a) for a in zip(*events)]
+    _save_escape(out, j, it, mag2, cont)
+    return _stats((out[0] if out.ndim > 1 else out)[j])
+
+#
+# Leading shape of images and value arrays: with the option mag2 the escape
+# values are in [0] and |z|^2 at the escape in [1]
+#
+def _layers(opts):
+    return (2,) if opts['mag2'] else ()
+
+#
+# Iterates the points c and saves the escape values at the same position in out.
+# The points are processed in blocks of <block> lanes in preallocated buffers
+# and escapes are only checked every <check> iterations. The buffers have the
+# float type of out.
+# With a <period_tol> lanes whose orbit returns to within period_tol of a
+# reference z, saved at doubling intervals, are retired as interior points.
+# The iteration can be continued from the values <z> after <start> iterations.
+# If a list <state> is given, (index, z) of the lanes still alive after
+# max_iter are appended to it. <cancel> is checked before every block, see _check.
+# The escapes are collected as events and saved in out at the end.
+# <step> does one iteration on the buffers, see _step.
+# Returns the escape_stats, with the number of points which were retired this way.
+#
+def _iterate(c, out, max_betr, max_iter, cont, period_tol=None, z=None, start=0, state=None,
+             cancel=None, block=16384, check=8, compact=0.5, step=_step):
+    buf = np.empty((10, min(block, len(c))), dtype=out.dtype)
+    flags = np.empty((2, buf.shape[1]), dtype=bool)
+    periodic = 0
+    events = []
+    for s in range(0, len(c), block):
+        _check(cancel)
+        z0 = None if z is None else z[s:s+block]
+        found = []
+        p, live = _iterate_block(c[s:s+block], found, z0, start, buf, flags, max_betr,
+                                 max_iter, period_tol, check, compact, state is not None, step)
+        periodic += p
+        events += [(j + s, it, mag2) for j, it, mag2 in found]
+        if state is not None and len(live[0]):
+            state.append((live[0] + s, live[1]))
+    stats = _save_escapes(out, events, cont)
+    stats.periodic = periodic
+    return stats
+
+def _iterate_block(c, events, z, start, buf, flags, max_betr, max_iter, period_tol,
+                   check, compact, save, step):
+    n = len(c)
+    zr, zi, cr, ci, rr, ri, sr, si, t1, t2 = [b[:n] for b in buf]
+    cr[:] = c.real
+    ci[:] = c.imag
+    if z is None:
+        zr[:] = cr
+        zi[:] = ci
+    else:
+        zr[:] = z.real
+        zi[:] = z.imag
+    alive = flags[0, :n]
+    alive[:] = True
+    # Position of every lane in out
+    idx = np.arange(n)
+    b2 = max_betr*max_betr
+    dead = 0
+    i = start
+    # Reference orbit point for the periodicity check
+    periodic = 0
+    if period_tol is not None:
+        rr[:] = zr
+        ri[:] = zi
+        next_ref = start + check
+    with np.errstate(over='ignore', invalid='ignore'):
+        while i < max_iter and n:
+            k = min(check, max_iter - i)
+            # Save z to replay the escaped lanes
+            sr[:] = zr
+            si[:] = zi
+            for _ in range(k):
+                step(zr, zi, cr, ci, t1, t2)
+
+            # Lanes with |z|^2 > max_betr^2, overflowed lanes (nan) included
+            np.multiply(zr, zr, t1)
+            np.multiply(zi, zi, t2)
+            np.add(t1, t2, t1)
+            esc = flags[1, :n]
+            np.less_equal(t1, b2, esc)
+            np.logical_not(esc, esc)
+            esc &= alive
+            e = np.flatnonzero(esc)
+            if len(e):
+                alive[e] = False
+                events.append(_replay(e, idx, sr, si, cr, ci, i, k, b2))
+                # A lane with z = c = 0 stays at 0 and never escapes again
+                zr[e] = zi[e] = cr[e] = ci[e] = 0
+                dead += len(e)
+            i += k
+
+            if period_tol is not None:
+                # Lanes back within period_tol of the reference are on a cycle
+                np.subtract(zr, rr, t1)
+                np.multiply(t1, t1, t1)
+                np.subtract(zi, ri, t2)
+                np.multiply(t2, t2, t2)
+                np.add(t1, t2, t1)
+                per = flags[1, :n]
+                np.less(t1, period_tol*period_tol, per)
+                per &= alive
+                p = np.flatnonzero(per)
+                if len(p):
+                    alive[p] = False
+                    zr[p] = zi[p] = cr[p] = ci[p] = 0
+                    dead += len(p)
+                    periodic += len(p)
+                # Move the reference forward at doubling intervals
+                if i >= next_ref:
+                    rr[:] = zr
+                    ri[:] = zi
+                    next_ref *= 2
+
+            # Compact the buffers once enough lanes have died
+            if dead > compact*n:
+                keep = np.flatnonzero(alive[:n])
+                n = len(keep)
+                for b in (zr, zi, cr, ci, rr, ri):
+                    b[:n] = b[keep]
+                idx = idx[keep]
+                zr, zi, cr, ci, rr, ri, sr, si, t1, t2 = [b[:n] for b in buf]
+                alive = flags[0, :n]
+                alive[:] = True
+                dead = 0
+
+    if not save:
+        return periodic, None
+    live = np.flatnonzero(alive[:n])
+    z = np.empty(len(live), dtype=np.result_type(buf.dtype, np.complex64))
+    z.real = zr[live]
+    z.imag = zi[live]
+    return periodic, (idx[live], z)
+
+#
+# Raised by _check to abort a calculation
+#
+class _cancelled(Exception):
+    pass
+
+#
+# Aborts the calculation if the object <cancel> (e.g. a threading.Event) is set
+#
+def _check(cancel):
+    if cancel is not None and cancel.is_set():
+        raise _cancelled()
+
+#
+# Checkpoint of a calculation between its tiles: aborts it on <cancel> (see
+# _check), tells if the time.time() <deadline> has passed and reports the
+# pixels done of <total> to progress(done, total)
+#
+class _watch():
+        def __init__(self, cancel=None, deadline=None, progress=None, total=0):
+            self.cancel = cancel
+            self.deadline = deadline
+            self.progress = progress
+            self.total = total
+            self.done = 0
+            # Set once the deadline has passed
+            self.expired = False
+
+        def check(self):
+            _check(self.cancel)
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.expired = True
+            return not self.expired
+
+        def advance(self, n):
+            self.done += n
+            if self.progress is not None:
+                self.progress(self.done, self.total)
+
+#
+# Iterates the escaped lanes e again from the saved z to find their exact escape
+# iteration. Returns the escape event (index, iteration, |z|^2) of the lanes.
+#
+def _replay(e, idx, sr, si, cr, ci, i, k, b2):
+    zr, zi, cr, ci = sr[e], si[e], cr[e], ci[e]
+    t1, t2 = np.empty_like(zr), np.empty_like(zr)
+    it = np.zeros(len(e), dtype=np.int64)
+    mag2 = np.zeros(len(e))
+    for j in range(1, k+1):
+        _step(zr, zi, cr, ci, t1, t2)
+        m = zr*zr + zi*zi
+        new = (it == 0) & (m > b2)
+        it[new] = i + j
+        mag2[new] = m[new]
+    return idx[e], it, mag2
+
+#
+# Per point version of _iterate_block for numba: every point is iterated on its
+# own until it escapes, so there are no dead lanes and no temporaries. The
+# escape and periodicity checks happen every <check> iterations like in
+# _iterate_block and the escape iteration is the first one with |z|^2 > b2 since
+# the last check, so the results are the same. An orbit with |z| > 2 and
+# |z| >= |c| grows for good, so with b2 >= 4 the iteration can stop there.
+# fate[p] is set to 1 for escaped points (with it and mag2) and 2 for periodic
+# ones, zr and zi are left at z of the points still alive.
+#
+def _escape_points(cr, ci, zr, zi, b2, tol2, max_iter, start, check, it, mag2, fate):
+    for p in prange(len(cr)):
+        x, y, a, b = zr[p], zi[p], cr[p], ci[p]
+        rx, ry = x, y
+        next_ref = start + check
+        m = x*x + y*y
+        c2 = a*a + b*b
+        i = start
+        while i < max_iter:
+            k = min(check, max_iter - i)
+            first, first_m = 0, m
+            for j in range(1, k+1):
+                t = x*y
+                x = x*x - y*y + a
+                y = t + t + b
+                m = x*x + y*y
+                if first == 0 and m > b2:
+                    first, first_m = i + j, m
+                    if b2 >= 4 and m >= c2:
+                        break
+            i += k
+            if not m <= b2:
+                it[p] = first
+                mag2[p] = first_m
+                fate[p] = 1
+                break
+            # tol2 < 0 without periodicity check
+            dx, dy = x - rx, y - ry
+            if dx*dx + dy*dy < tol2:
+                fate[p] = 2
+                break
+            if i >= next_ref:
+                rx, ry = x, y
+                next_ref *= 2
+        zr[p], zi[p] = x, y
+
+if numba is not None:
+    prange = numba.prange
+    _escape_kernel = numba.njit(parallel=True, cache=True)(_escape_points)
+else:
+    prange = range
+    _escape_kernel = _escape_points
+
+#
+# _iterate with the kernel _escape_points compiled by numba, the points are
+# processed in parallel threads. The arguments and the result are those of
+# _iterate, the blocks only serve to check <cancel>.
+#
+def _iterate_numba(c, out, max_betr, max_iter, cont, period_tol=None, z=None, start=0, state=None,
+                   cancel=None, block=65536, check=8):
+    dtype = out.dtype.type
+    cr, ci = c.real.astype(dtype), c.imag.astype(dtype)
+    if z is None:
+        zr, zi = cr.copy(), ci.copy()
+    else:
+        zr, zi = z.real.astype(dtype), z.imag.astype(dtype)
+    it = np.zeros(len(c), dtype=np.int64)
+    mag2 = np.zeros(len(c))
+    fate = np.zeros(len(c), dtype=np.int8)
+    # The comparisons are done in the float type of out, as by numpy
+    b2 = dtype(max_betr*max_betr)
+    tol2 = dtype(-1 if period_tol is None else period_tol*period_tol)
+    for s in range(0, len(c), block):
+        _check(cancel)
+        b = slice(s, s+block)
+        _escape_kernel(cr[b], ci[b], zr[b], zi[b], b2, tol2, max_iter, start, check,
+                       it[b], mag2[b], fate[b])
+    e = np.flatnonzero(fate == 1)
+    stats = _save_escapes(out, [(e, it[e], mag2[e])], cont)
+    stats.periodic = int(np.count_nonzero(fate == 2))
+    live = np.flatnonzero(fate == 0)
+    if state is not None and len(live):
+        z = np.empty(len(live), dtype=np.result_type(dtype, np.complex64))
+        z.real = zr[live]
+        z.imag = zi[live]
+        state.append((live, z))
+    return stats
+
+def _iterate_numexpr(*args, **kwargs):
+    return _iterate(*args, step=_step_numexpr, **kwargs)
+
+#
+# Kernels which iterate points like _iterate by the name of their backend, the
+# optional ones only if their module is installed. They all give the same values.
+#
+_backends = OrderedDict([("numpy", _iterate)])
+if numba is not None:
+    _backends["numba"] = _iterate_numba
+if numexpr is not None:
+    _backends["numexpr"] = _iterate_numexpr
+
+#
+# Name of the backend to use for <backend>: "auto" is the fastest one
+# installed, a missing optional one falls back to "numpy"
+#
+def _backend(backend):
+    if backend == "auto":
+        return [b for b in ("numba", "numexpr", "numpy") if b in _backends][0]
+    if backend not in ("numpy", "numba", "numexpr"):
+        raise ValueError("Unknown backend: %s" % backend)
+    return backend if backend in _backends else "numpy"
+
+#
+# Double-double arithmetic on (hi, lo) pairs of float64 arrays with the
+# error-free transformations two-sum and two-prod (Dekker split)
+#
+def _two_sum(a, b):
+    s = a + b
+    bb = s - a
+    return s, (a - (s - bb)) + (b - bb)
+
+def _quick_two_sum(a, b):
+    s = a + b
+    return s, b - (s - a)
+
+def _two_prod(a, b):
+    p = a*b
+    t = 134217729.0*a
+    ah = t - (t - a)
+    al = a - ah
+    t = 134217729.0*b
+    bh = t - (t - b)
+    bl = b - bh
+    return p, ((ah*bh - p) + ah*bl + al*bh) + al*bl
+
+def _dd_add(a, b):
+    s, e = _two_sum(a[0], b[0])
+    t, f = _two_sum(a[1], b[1])
+    s, e = _quick_two_sum(s, e + t)
+    return _quick_two_sum(s, e + f)
+
+def _dd_mul(a, b):
+    p, e = _two_prod(a[0], b[0])
+    return _quick_two_sum(p, e + (a[0]*b[1] + a[1]*b[0]))
+
+#
+# Iterates the double-double points (cr, ci) and saves the escape values at the
+# same position in out (see _save_escapes), the escape test uses the hi parts only.
+# <cancel> is checked every <check> iterations (see _check). Returns the escape_stats.
+#
+def _iterate_dd(cr, ci, out, max_betr, max_iter, cont, cancel=None, check=64):
+    # Position of every remaining point in out
+    idx = np.arange(out.shape[-1])
+    zr, zi = cr, ci
+    b2 = max_betr*max_betr
+    events = []
+    with np.errstate(over='ignore', invalid='ignore'):
+        for i in range(max_iter):
+            if not len(idx): break;
+            if i % check == 0:
+                _check(cancel)
+            r2 = _dd_mul(zr, zr)
+            i2 = _dd_mul(zi, zi)
+            ri = _dd_mul(zr, zi)
+            zr = _dd_add(_dd_add(r2, (-i2[0], -i2[1])), cr)
+            zi = _dd_add((2*ri[0], 2*ri[1]), ci)
+            m = zr[0]*zr[0] + zi[0]*zi[0]
+            esc = ~(m <= b2)
+            if esc.any():
+                events.append((idx[esc], np.full(esc.sum(), i+1, dtype=np.int64), m[esc]))
+                # remove all escaped points
+                rem = ~esc
+                idx = idx[rem]
+                zr, zi = (zr[0][rem], zr[1][rem]), (zi[0][rem], zi[1][rem])
+                cr, ci = (cr[0][rem], cr[1][rem]), (ci[0][rem], ci[1][rem])
+    return _save_escapes(out, events, cont)
+
+#
+# Points in the main cardioid or the period-2 bulb, which never escape
+#
+def _interior(c):
+    x, y = c.real, c.imag
+    xq = x - 0.25
+    y2 = y*y
+    q = xq*xq + y2
+    return (q*(q + xq) <= 0.25*y2) | ((x + 1)*(x + 1) + y2 <= 0.0625)
+
+#
+# Calculates the escape values of the points c, see _iterate for <state>.
+# Returns the values and their escape_stats. <cancel> is checked by the kernel,
+# see _iterate.
+#
+def _calc(c, opts, state=None, cancel=None):
+    out = np.zeros(_layers(opts) + c.shape, dtype=opts['dtype'])
+    args = (opts['max_betr'], opts['max_iter'], opts['cont'], opts['period_tol'])
+    iterate = _backends[opts['backend']]
+    if opts['reject']:
+        # Interior points keep the value 0 without being iterated
+        m = np.flatnonzero(~_interior(c))
+        part = np.zeros(_layers(opts) + (len(m),), dtype=out.dtype)
+        live = None if state is None else []
+        stats = iterate(c[m], part, *args, state=live, cancel=cancel)
+        out[..., m] = part
+        if state is not None:
+            state += [(m[i], z) for i, z in live]
+    else:
+        stats = iterate(c, out, *args, state=state, cancel=cancel)
+    return out, stats
+
+#
+# Calculates the escape values of double-double points, the rows of cr and ci
+# are the hi and lo parts. The periodicity check is not supported.
+#
+def _calc_dd(cr, ci, opts, cancel=None):
+    out = np.zeros(_layers(opts) + (cr.shape[1],), dtype=np.float64)
+    m = np.arange(cr.shape[1])
+    if opts['reject']:
+        m = np.flatnonzero(~_interior(cr[0] + complex(0,1)*ci[0]))
+    part = np.zeros(_layers(opts) + (len(m),), dtype=out.dtype)
+    stats = _iterate_dd((cr[0, m], cr[1, m]), (ci[0, m], ci[1, m]), part,
+                        opts['max_betr'], opts['max_iter'], opts['cont'], cancel)
+    out[..., m] = part
+    return out, stats
+
+#
+# Calculates the escape values of the pixels (px, py) of the axes x and y.
+# If a list <state> is given, (px, py, z, c) of the points still alive after
+# max_iter are appended to it, this is not supported for "dd". The calculation
+# is aborted if <cancel> gets set, see _check.
+#
+def _calc_at(x, y, px, py, opts, state=None, cancel=None):
+    if opts['precision'] == "dd":
+        return _calc_dd(x[:, px], y[:, py], opts, cancel)
+    c = x[px] + complex(0,1)*y[py]
+    live = None if state is None else []
+    out, stats = _calc(c, opts, live, cancel)
+    if state is not None:
+        state += [(px[i], py[i], z, c[i]) for i, z in live]
+    return out, stats
+
+#
+# Cheapest precision which resolves the pixel pitch of the viewport: float32
+# keeps overviews visually exact down to a pitch of 1e-3, but only for up to 256
+# iterations (<max_iter>), its rounding errors grow along the orbits near the
+# boundary. float64 holds down to 1e-14, double-double to 1e-22 and beyond only
+# perturbation works.
+#
+def _precision(re_min, re_max, res, max_iter=None):
+    pitch = float(Decimal(re_max) - Decimal(re_min)) / res
+    if pitch >= 1e-3 and max_iter is not None and max_iter <= 256:
+        return "single"
+    if pitch >= 1e-14:
+        return "double"
+    if pitch >= 1e-22:
+        return "dd"
+    return "perturb"
+
+#
+# Concatenated ranges start[i] .. start[i]+n[i]-1 of the int arrays start and n
+#
+def _ranges(start, n):
+    return np.repeat(start - np.cumsum(n) + n, n) + np.arange(n.sum())
+
+#
+# Flat indices (rows of length <ny>) of the pixels of the rectangles x0:x1,
+# y0:y1 (int arrays), grouped by rectangle
+#
+def _rect_pixels(x0, x1, y0, y1, ny):
+    rows = _ranges(x0, x1-x0)
+    r = np.repeat(np.arange(len(x0)), x1-x0)
+    return _ranges(rows*ny + y0[r], (y1-y0)[r])
+
+#
+# Minimum and maximum of v over the pixels of every rectangle x0:x1, y0:y1
+#
+def _rect_range(v, x0, x1, y0, y1):
+    f = _rect_pixels(x0, x1, y0, y1, v.shape[-1])
+    n = (x1-x0) * (y1-y0)
+    first = np.cumsum(n) - n
+    val = v.ravel()[f]
+    return np.minimum.reduceat(val, first), np.maximum.reduceat(val, first)
+
+#
+# Mariani-Silver subdivision: Only the border of a rectangle is calculated,
+# if it has one value everywhere the rectangle is filled with it, otherwise
+# it is split in four and the parts are checked the same way. The rectangles
+# of one level are handled together, their borders are calculated in one batch.
+# Details smaller than the border spacing which are completely enclosed by a
+# uniform border (e.g. thin filaments) are filled over. With <cont> the values
+# of escaped points are rarely equal, so mostly interior regions are filled.
+# With the option mag2 only interior regions are filled, |z|^2 differs for
+# every escaped point.
+# The _watch <watch> is checked and advanced after every level, once its
+# deadline has passed the pixels not done are left at -1.
+#
+def _subdivide(x, y, opts, min_size=4, watch=None):
+    if watch is None:
+        watch = _watch()
+    nx, ny = shape = (x.shape[-1], y.shape[-1])
+    img = np.zeros(_layers(opts) + shape, dtype=opts['dtype'])
+    # Escape values of the pixels
+    v = img[0] if opts['mag2'] else img
+    # Flat views of the pixels
+    flat = img.reshape(img.shape[:-2] + (-1,))
+    done = np.zeros(nx*ny, dtype=bool)
+    todo = np.zeros(nx*ny, dtype=bool)
+    stats = escape_stats()
+    # Rectangles x0:x1, y0:y1 of the level
+    x0, x1, y0, y1 = [np.array([a], dtype=np.intp) for a in (0, nx, 0, ny)]
+    while len(x0):
+        if not watch.check():
+            v[~done.reshape(shape)] = -1
+            break
+        # All pixels of the small rectangles and the borders of the big ones
+        small = (x1-x0 <= min_size) | (y1-y0 <= min_size)
+        todo[_rect_pixels(x0[small], x1[small], y0[small], y1[small], ny)] = True
+        b = ~small
+        x0, x1, y0, y1 = x0[b], x1[b], y0[b], y1[b]
+        sides = [(x0, x0+1, y0, y1), (x1-1, x1, y0, y1), (x0, x1, y0, y0+1), (x0, x1, y1-1, y1)]
+        for side in sides:
+            todo[_rect_pixels(*side, ny=ny)] = True
+        todo &= ~done
+        f = np.flatnonzero(todo)
+        todo[f] = False
+        flat[..., f], st = _calc_at(x, y, f // ny, f % ny, opts, cancel=watch.cancel)
+        done[f] = True
+        stats += st
+        if not len(x0):
+            watch.advance(len(f))
+            break
+
+        # Rectangles whose border has one value
+        lo, hi = zip(*[_rect_range(v, *side) for side in sides])
+        lo, hi = np.min(lo, axis=0), np.max(hi, axis=0)
+        uniform = lo == hi
+        if opts['mag2']:
+            uniform &= hi == 0
+        # Fill their insides
+        u = np.flatnonzero(uniform)
+        cnt = ((x1-x0-2) * (y1-y0-2))[u]
+        fill = _rect_pixels(x0[u]+1, x1[u]-1, y0[u]+1, y1[u]-1, ny)
+        flat[..., fill] = np.repeat(lo[u], cnt)
+        done[fill] = True
+        e = lo[u] > 0
+        if e.any():
+            val = lo[u][e]
+            stats += escape_stats(int(cnt[e].sum()), val.max(), val.min(),
+                                  np.bincount(val.astype(np.int64), cnt[e]).astype(np.int64))
+        watch.advance(len(f) + len(fill))
+
+        # Split the others in four, the parts share the middle row and column
+        b = ~uniform
+        x0, x1, y0, y1 = x0[b], x1[b], y0[b], y1[b]
+        xm, ym = (x0+x1)//2, (y0+y1)//2
+        x0, x1, y0, y1 = (np.concatenate((x0, xm, x0, xm)), np.concatenate((xm+1, x1, xm+1, x1)),
+                          np.concatenate((y0, y0, ym, ym)), np.concatenate((ym+1, ym+1, y1, y1)))
+    return img, stats
+
+#
+# Escape iterations of the escape values v with their |z|^2 (see _layers), 0
+# for the points which didn't escape
+#
+def _iterations(v, mag2, cont):
+    it = np.zeros(v.shape, dtype=np.int64)
+    esc = mag2 > 0
+    it[esc] = _escape_iter(v[esc], mag2[esc]) if cont else v[esc]
+    return it
+
+#
+# Distance estimate 2|z|ln|z| / |dz| of the points c to the set, with the
+# derivative dz/dc iterated along z up to the escape iterations <it> of the
+# points. The points are iterated in the order of it, so every iteration only
+# touches those still going. The distance is between a quarter of the
+# estimate and the estimate.
+#
+def _distance(c, it):
+    if not len(c):
+        return np.zeros(0)
+    order = np.argsort(it, kind='mergesort')
+    c, it = c[order].astype(np.complex128), it[order]
+    z, dz = c.copy(), np.ones_like(c)
+    with np.errstate(over='ignore', invalid='ignore'):
+        for n in range(1, int(it[-1]) + 1):
+            # The points which escaped before n are done
+            k = np.searchsorted(it, n)
+            dz[k:] = 2*z[k:]*dz[k:] + 1
+            z[k:] = z[k:]*z[k:] + c[k:]
+        # The estimate needs a large |z|, which takes a few more iterations
+        for _ in range(64):
+            m = np.flatnonzero(np.abs(z) < 1e8)
+            if not len(m):
+                break
+            dz[m] = 2*z[m]*dz[m] + 1
+            z[m] = z[m]*z[m] + c[m]
+        a = np.abs(z)
+        de = np.empty(len(c))
+        de[order] = 2*a*np.log(a) / np.abs(dz)
+    return de
+
+#
+# _render() guided by the distance estimate (see _distance): every <step>-th
+# pixel (and the last one) of both axes is calculated first. The cells between
+# them whose corners all escaped and are farther from the set than the cell
+# diagonal (by a quarter of the estimate) are filled by bilinear interpolation
+# of the corners if these are equal, with cont if they differ by at most
+# <spread>. The other pixels are calculated with _render_pixels.
+# This is an approximation: with cont the filled pixels are off by up to about
+# twice <spread>, without cont a cell can hide a detail smaller than the cell.
+# Only the pixels far from the set are filled, which escape early, so it saves
+# little unless those take many iterations, too.
+#
+def _render_de(x, y, opts, workers, tile, watch, step=4, batch=2**16, spread=0.1):
+    shape = (len(x), len(y))
+    # Both layers of the pixels, see _layers
+    full = dict(opts, mode="brute", mag2=True)
+    img = np.full((2,) + shape, -1, dtype=opts['dtype'])
+    done = np.zeros(shape, dtype=bool)
+    gx = np.unique(np.r_[0:shape[0]:step, shape[0]-1])
+    gy = np.unique(np.r_[0:shape[1]:step, shape[1]-1])
+    grid, stats = _render(x[gx], y[gy], full, workers, tile, None, watch)
+    img[:, gx[:, None], gy] = grid
+    done[gx[:, None], gy] = True
+
+    if min(shape) > 1:
+        it = _iterations(grid[0], grid[1], opts['cont'])
+        de = np.zeros(it.shape)
+        esc = it > 0
+        de[esc] = _distance((x[gx, None] + complex(0,1)*y[gy])[esc], it[esc]) / 4
+        # Cells whose corners are all farther from the set than the cell diagonal
+        diag = np.hypot(np.diff(x[gx])[:, None], np.diff(y[gy]))
+        far = (np.minimum(np.minimum(de[:-1, :-1], de[1:, :-1]),
+                          np.minimum(de[:-1, 1:], de[1:, 1:])) > diag)
+        v = grid[0]
+        corners = (v[:-1, :-1], v[1:, :-1], v[:-1, 1:], v[1:, 1:])
+        far &= (np.max(corners, axis=0) - np.min(corners, axis=0)) <= (spread if opts['cont'] else 0)
+        # Cell of every pixel and its position in the cell
+        ix = np.clip(np.searchsorted(gx, np.arange(shape[0]), 'right') - 1, 0, len(gx)-2)
+        iy = np.clip(np.searchsorted(gy, np.arange(shape[1]), 'right') - 1, 0, len(gy)-2)
+        fill = far[ix[:, None], iy] & ~done
+        a, b = np.nonzero(fill)
+        ca, cb = ix[a], iy[b]
+        u = (a - gx[ca]) / np.diff(gx)[ca].astype(float)
+        w = (b - gy[cb]) / np.diff(gy)[cb].astype(float)
+        v = (grid[:, ca, cb]*(1-u)*(1-w) + grid[:, ca+1, cb]*u*(1-w) +
+             grid[:, ca, cb+1]*(1-u)*w + grid[:, ca+1, cb+1]*u*w)
+        img[:, a, b] = v
+        stats += _stats(v[0])
+        done |= fill
+        watch.advance(len(a))
+
+    px, py = np.nonzero(~done)
+    stats += _render_pixels(img, x, y, px, py, full, workers, watch, batch)
+    return (img if opts['mag2'] else img[0]), stats
+
+def _worker_pixels(p):
+    x, y, opts, keep, deadline = _worker['args']
+    px, py = p
+    out, stats = _calc_at(x, y, px, py, opts)
+    _worker['img'][..., px, py] = out
+    return len(px), stats
+
+#
+# Calculates the pixels px, py of the image img in place, in batches of up to
+# <batch> on <workers> processes (None: one per cpu core). The _watch <watch>
+# is checked after every batch, once its deadline has passed the pixels of the
+# batches not done are left as they are. Returns their escape_stats.
+#
+def _render_pixels(img, x, y, px, py, opts, workers=1, watch=None, batch=2**16):
+    if watch is None:
+        watch = _watch()
+    if workers is None:
+        workers = mp.cpu_count()
+    stats = escape_stats()
+    if workers <= 1 or len(px) <= batch // 4:
+        for s in range(0, len(px), batch):
+            if not watch.check():
+                break
+            out, st = _calc_at(x, y, px[s:s+batch], py[s:s+batch], opts, cancel=watch.cancel)
+            img[..., px[s:s+batch], py[s:s+batch]] = out
+            stats += st
+            watch.advance(len(px[s:s+batch]))
+        return stats
+
+    # Several batches per worker, the pixels differ a lot in cost
+    n = max(1024, min(batch, -(-len(px) // (4*workers))))
+    parts = [(px[s:s+n], py[s:s+n]) for s in range(0, len(px), n)]
+    buf = mp.RawArray(np.dtype(opts['dtype']).char, img.size)
+    shared = np.frombuffer(buf, dtype=opts['dtype']).reshape(img.shape)
+    shared[...] = img
+    pool = mp.Pool(min(workers, len(parts)), initializer=_init_worker,
+                   initargs=(buf, img.shape, x, y, opts, False, watch.deadline))
+    left = len(parts)
+    try:
+        results = pool.imap_unordered(_worker_pixels, parts)
+        while left and watch.check():
+            # Wait in short steps, a cancel doesn't have to wait for a long batch
+            try:
+                k, st = results.next(0.05)
+            except mp.TimeoutError:
+                continue
+            stats += st
+            left -= 1
+            watch.advance(k)
+    finally:
+        if left:
+            pool.terminate()
+        pool.close()
+        pool.join()
+    img[...] = shared
+    return stats
+
+#
+# Strips of whole columns for the mode "subdivide", <n> of them along the first axis
+#
+def _strips(pix_x, pix_y, n):
+    edges = np.linspace(0, pix_x, min(n, pix_x) + 1).astype(int)
+    return [(int(x0), int(x1), 0, pix_y) for x0, x1 in zip(edges[:-1], edges[1:])]
+
+#
+# Calculates one tile of the image in place, see _calc_at for <state>. The
+# _watch <watch> gives the cancel event, for "subdivide" it is also checked
+# and advanced after every level.
+#
+def _render_tile(img, x, y, t, opts, state=None, watch=None):
+    x0, x1, y0, y1 = t
+    if watch is None:
+        watch = _watch()
+    if opts['mode'] == "subdivide":
+        out, stats = _subdivide(x[..., x0:x1], y[..., y0:y1], opts, watch=watch)
+    else:
+        px, py = np.mgrid[x0:x1, y0:y1]
+        out, stats = _calc_at(x, y, px.ravel(), py.ravel(), opts, state, watch.cancel)
+    img[..., x0:x1, y0:y1] = out.reshape(img[..., x0:x1, y0:y1].shape)
+    return stats
+
+# State of a worker process, set once by _init_worker
+_worker = {}
+
+def _init_worker(buf, shape, x, y, opts, keep, deadline=None):
+    # The image lives in shared memory, workers write their tiles directly into it
+    _worker['img'] = np.frombuffer(buf, dtype=opts['dtype']).reshape(shape)
+    _worker['args'] = (x, y, opts, keep, deadline)
+    # The pool already runs one process per core, the parallel kernels of the
+    # backends would start one thread per core in each of them
+    if numba is not None:
+        numba.set_num_threads(1)
+    if numexpr is not None:
+        numexpr.set_num_threads(1)
+
+def _worker_tile(t):
+    x, y, opts, keep, deadline = _worker['args']
+    # The state of the tile goes back to the parent with the result
+    state = [] if keep else None
+    return t, _render_tile(_worker['img'], x, y, t, opts, state, _watch(deadline=deadline)), state
+
+#
+# Calculates the image for the pixel axes x and y, tile by tile
+# on <workers> processes (None: one per cpu core), see _calc_at for <state>.
+# The _watch <watch> is checked after every tile, once its deadline has
+# passed the tiles not done yet are left at -1. Without workers its cancel is
+# also checked during a tile.
+# The mode "subdivide" is not split in tiles, the levels of _subdivide are
+# batched over the whole image or, with workers, over one strip per worker
+# and checked against the deadline inside.
+# Rows of y which mirror others at the real axis are not calculated, see
+# _render_mirrored. The mode "de" is rendered by _render_de.
+# Returns the image and the escape_stats of the tiles calculated.
+#
+def _render(x, y, opts, workers=1, tile=128, state=None, watch=None):
+    if watch is None:
+        watch = _watch()
+    mirror = _mirror(y)
+    if mirror is not None:
+        return _render_mirrored(x, y, opts, workers, tile, state, watch, mirror)
+    if opts['mode'] == "de":
+        return _render_de(x, y, opts, workers, tile, watch)
+    shape = (x.shape[-1], y.shape[-1])
+    if workers is None:
+        workers = mp.cpu_count()
+    subdivide = opts['mode'] == "subdivide"
+    if subdivide:
+        # Two strips per worker, the parts of the image differ a lot in cost
+        tiles = _strips(shape[0], shape[1], 2*workers if workers > 1 else 1)
+    else:
+        tiles = _tiles(shape[0], shape[1], tile)
+    workers = min(workers, len(tiles))
+    left = set(tiles)
+    stats = escape_stats()
+    shape = _layers(opts) + shape
+
+    if workers <= 1:
+        img = np.zeros(shape, dtype=opts['dtype'])
+        for t in tiles:
+            if not watch.check():
+                break
+            stats += _render_tile(img, x, y, t, opts, state, watch)
+            left.discard(t)
+            if not subdivide:
+                # _subdivide advances the watch by itself
+                watch.advance((t[1]-t[0]) * (t[3]-t[2]))
+    else:
+        buf = mp.RawArray(np.dtype(opts['dtype']).char, int(np.prod(shape)))
+        img = np.frombuffer(buf, dtype=opts['dtype']).reshape(shape)
+        pool = mp.Pool(workers, initializer=_init_worker,
+                       initargs=(buf, shape, x, y, opts, state is not None, watch.deadline))
+        try:
+            results = pool.imap_unordered(_worker_tile, tiles)
+            while left and watch.check():
+                # Wait in short steps, a cancel doesn't have to wait for a long tile
+                try:
+                    t, s, st = results.next(0.05)
+                except mp.TimeoutError:
+                    continue
+                stats += s
+                if state is not None:
+                    state += st
+                left.discard(t)
+                watch.advance((t[1]-t[0]) * (t[3]-t[2]))
+        finally:
+            if left:
+                # Cancelled, expired or failed, don't wait for the other tiles
+                pool.terminate()
+            pool.close()
+            pool.join()
+
+    for x0, x1, y0, y1 in left:
+        img[..., x0:x1, y0:y1] = -1
+    return img, stats
+
+#
+# Rows of the pixel axis y (the hi parts for "dd") which mirror another row at
+# the real axis to within <tol> of the row spacing. The side of the real axis
+# with fewer rows is mirrored from the other one. Returns the rows and the rows
+# they mirror or None if there are none.
+#
+def _mirror(y, tol=1e-3):
+    if y.ndim > 1:
+        y = y[0]
+    neg, pos = np.flatnonzero(y < 0), np.flatnonzero(y > 0)
+    if not len(neg) or not len(pos):
+        return None
+    dst, src = (neg, pos) if len(neg) <= len(pos) else (pos, neg)
+    # Nearest row of src for every row of dst
+    order = src[np.argsort(-y[src])]
+    m = -y[order]
+    k = np.searchsorted(m, y[dst])
+    lo, hi = np.clip(k-1, 0, len(m)-1), np.clip(k, 0, len(m)-1)
+    k = np.where(abs(m[lo] - y[dst]) < abs(m[hi] - y[dst]), lo, hi)
+    ok = abs(m[k] - y[dst]) <= tol * np.diff(np.sort(y)).min()
+    if not ok.any():
+        return None
+    return dst[ok], order[k[ok]]
+
+#
+# _render() for the rows <mirror> of _mirror: the set is symmetric under
+# conjugation, so only the other rows are calculated and the mirrored ones are
+# copied from them. The points alive on them continue from the conjugate z and c.
+# With a period_tol the rows mirrored are calculated apart from the others,
+# grouped by how often they are mirrored, so the points found periodic on
+# them can be counted for their copies as well.
+#
+def _render_mirrored(x, y, opts, workers, tile, state, watch, mirror):
+    dst, src = mirror
+    keep = np.setdiff1d(np.arange(y.shape[-1]), dst)
+    # Rows calculated together and the number of copies of each of them
+    groups = [(keep, 0)]
+    if opts['period_tol'] is not None:
+        rows, n = np.unique(src, return_counts=True)
+        groups = [(np.setdiff1d(keep, rows), 0)] + [(rows[n == k], k) for k in np.unique(n)]
+    img = np.empty(_layers(opts) + (x.shape[-1], y.shape[-1]), dtype=opts['dtype'])
+    stats = escape_stats()
+    part = None if state is None else []
+    for rows, k in groups:
+        if not len(rows):
+            continue
+        p = None if state is None else []
+        img[..., rows], s = _render(x, y[..., rows], opts, workers, tile, p, watch)
+        stats += s
+        stats.periodic += k * s.periodic
+        if state is not None:
+            part += [(px, rows[py], z, c) for px, py, z, c in p]
+    img[..., dst] = img[..., src]
+    stats += _stats(img[0][:, dst] if opts['mag2'] else img[:, dst])
+    watch.advance(x.shape[-1] * len(dst))
+    if state is not None:
+        # Row mirroring each row, -1 for none
+        rows = np.full(y.shape[-1], -1, dtype=np.intp)
+        rows[src] = dst
+        for px, py, z, c in part:
+            m = rows[py] >= 0
+            state += [(px, py, z, c), (px[m], rows[py[m]], z[m].conj(), c[m].conj())]
+    return img, stats
+
+#
+# Pixels of the image of the fractal_data <prev> on the pixel axes x and y.
+# For every axis the slice of the pixels which coincide with pixels of prev
+# (the pitch has to be a multiple of the one of prev) and the slice of those
+# pixels in prev. Returns None if prev was calculated with other options or
+# the grids don't align. Only images of the mode "brute" are exact in every
+# pixel, the other modes fill pixels which are then not copied.
+#
+def _aligned(prev, x, y, opts, tol=1e-3):
+    if prev is None or prev.opts is None or prev.extent is None:
+        return None
+    if opts['precision'] not in ("single", "double") or prev.opts['mode'] != "brute":
+        return None
+    keys = ('max_betr', 'max_iter', 'cont', 'reject', 'period_tol', 'precision', 'mag2')
+    if any(prev.opts[k] != opts[k] for k in keys):
+        return None
+    e = [float(v) for v in prev.extent]
+    slices = []
+    for a, lo, hi, n in ((x, e[0], e[1], prev.data.shape[0]), (y, e[2], e[3], prev.data.shape[1])):
+        if n < 2 or len(a) < 2:
+            return None
+        # Pitch and first pixel of the axis in pixels of prev
+        q = (a[-1] - a[0]) / (len(a)-1) / ((hi - lo) / (n-1))
+        f = (a[0] - lo) / ((hi - lo) / (n-1))
+        r, o = int(round(q)), int(round(f))
+        if r < 1 or abs(q - r) * len(a) > tol or abs(f - o) > tol:
+            return None
+        # Pixels k of the axis with 0 <= o + k*r < n
+        k0 = max(0, -(o // r))
+        k1 = min(len(a), (n-1-o) // r + 1)
+        if k0 >= k1:
+            return None
+        slices.append((slice(k0, k1), slice(o + k0*r, o + (k1-1)*r + 1, r)))
+    return slices
+
+#
+# _render() which copies the pixels aligned with the image of the fractal_data
+# <prev> (see _aligned) and only calculates the frame around them. With a
+# <state> the one of prev is taken over as well.
+#
+def _render_prev(x, y, opts, workers=1, tile=128, prev=None, state=None, watch=None):
+    a = _aligned(prev, x, y, opts)
+    if a is None or (state is not None and prev.state is None):
+        return _render(x, y, opts, workers, tile, state, watch)
+    (kx, jx), (ky, jy) = a
+    shape = (x.shape[-1], y.shape[-1])
+    img = np.zeros(_layers(opts) + shape, dtype=opts['dtype'])
+    if opts['mag2']:
+        img[..., kx, ky] = prev.data[jx, jy], prev.mag2[jx, jy]
+    else:
+        img[kx, ky] = prev.data[jx, jy]
+    stats = _stats(img[0, kx, ky] if opts['mag2'] else img[kx, ky])
+    if watch is not None:
+        watch.advance((kx.stop - kx.start) * (ky.stop - ky.start))
 
-def mandelbrot(re_min, re_max, im_min, im_max, max_betr, max_iter, res=400, cont=False):
+    # Left and right of the copied pixels in full height, then below and above
+    ix = np.r_[0:kx.start, kx.stop:shape[0]]
+    iy = np.r_[0:ky.start, ky.stop:shape[1]]
+    mx = np.arange(kx.start, kx.stop)
+    for px, py in ((ix, np.arange(shape[1])), (mx, iy)):
+        if not len(px) or not len(py):
+            continue
+        part = None if state is None else []
+        img[..., px[:, None], py], s = _render(x[..., px], y[..., py], opts, workers, tile, part, watch)
+        stats += s
+        if state is not None:
+            state += [(px[i], py[j], z, c) for i, j, z, c in part]
+
+    if state is not None:
+        # Points alive in prev on the copied pixels
+        st = prev.state
+        ox, oy = np.divmod(st['idx'], prev.data.shape[1])
+        m = ((ox >= jx.start) & (ox < jx.stop) & ((ox - jx.start) % jx.step == 0) &
+             (oy >= jy.start) & (oy < jy.stop) & ((oy - jy.start) % jy.step == 0))
+        state.append(((ox[m] - jx.start) // jx.step + kx.start,
+                      (oy[m] - jy.start) // jy.step + ky.start, st['z'][m], st['c'][m]))
+    return img, stats
+
+#
+# Calculates the mandelbrot set. Points in the main cardioid and the period-2
+# bulb are marked as interior without iterating them if <reject> is set. Rows
+# which mirror others at the real axis are copied from them, see _mirror. This
+# needs a grid aligned to the real axis, e.g. im_min = -im_max, otherwise no
+# row mirrors another one and all of them are calculated.
+# With a <period_tol> orbits which return to within period_tol are
+# terminated early as interior points, see fractal_data.periodic.
+# <mode> is "brute" to calculate every pixel, "subdivide" to fill uniform
+# rectangles from their border (see _subdivide) or "de" to interpolate cells
+# far from the set by their distance estimate, an approximation (see
+# _render_de, "dd" and "perturb" calculate every pixel).
+# <precision> is "single" for float32 (with a float32 image), "double" for
+# float64, "dd" for double-double arithmetic (about 32 digits, for zooms to a
+# width of 1e-20 .. 1e-28, the deeper the fewer iterations stay exact) or
+# "perturb" for mandelbrot_perturb(). With "auto" it is chosen from the pixel
+# pitch, see _precision. For "dd" and "perturb" the coordinates should be
+# given as strings or Decimals. The precision used is in fractal_data.precision.
+# With <keep_state> z and c of the points still alive are kept in
+# fractal_data.state to continue them with mandelbrot_resume(). This is only
+# possible for the mode "brute" in single or double precision, otherwise
+# fractal_data.state stays None.
+# The pixels of the fractal_data <prev> of a previous render, e.g. before a
+# zoom out, which lie on the grid of this one are copied instead of calculated
+# if it was calculated with the same options.
+# If the object <cancel> (e.g. a threading.Event) gets set, the calculation
+# stops after the current tile and None is returned. Once the time.time()
+# <deadline> has passed no more tiles are started, the pixels not calculated
+# are -1 and fractal_data.complete is False. progress(done, total) is called
+# with the pixels done after every tile.
+# With <keep_mag2> |z|^2 of the points at their escape is kept in
+# fractal_data.mag2, so fractal_data.values() can switch between continuous
+# and iteration values without calculating again.
+# <max_iter> can be "auto" to choose it with auto_iter(), the value used is in
+# fractal_data.max_iter.
+# <backend> is the kernel for "single" and "double": "numpy", "numba" (compiled,
+# parallel over the points) or "numexpr", the last two fall back to "numpy" if
+# they aren't installed. "auto" takes the fastest one installed. All of them
+# calculate the same image.
+# With <aa> > 0 the pixels on edges are anti-aliased with aa*aa samples, see
+# _antialias, and fractal_data.antialiased is their number. Such an image has
+# no state and isn't used as <prev>, "dd" and "perturb" aren't anti-aliased.
+# With <de> the distance estimate of every escaped pixel is calculated into
+# fractal_data.de (see _distance), this keeps mag2 as well. Not for "dd" and
+# "perturb".
+# Complete images are taken from and saved to the disk_cache <disk>.
+#
+def mandelbrot(re_min, re_max, im_min, im_max, max_betr, max_iter, res=400, cont=False,
+               workers=1, tile=128, reject=True, period_tol=None, mode="brute",
+               precision="auto", keep_state=False, prev=None, cancel=None, deadline=None,
+               progress=None, keep_mag2=False, backend="auto", aa=0, aa_tol=0.3, aa_seed=0,
+               de=False, disk=None):
     # Save Startime
     start_t = time.time()
-    # ix and iy is an 2-dimensional array representing the pixels
-    pix_y = int(round(res / (re_max - re_min) * (im_max - im_min)))
+    opts = dict(max_betr=max_betr, max_iter=max_iter, cont=cont, reject=reject,
+                period_tol=period_tol, mode=mode, precision=precision, mag2=keep_mag2 or de,
+                backend=backend)
+    try:
+        x, y = _setup(re_min, re_max, im_min, im_max, res, opts, cancel)
+    except _cancelled:
+        return None
+    if opts['precision'] not in ("single", "double"):
+        aa = de = False
+    if disk is not None:
+        key = _disk_key(disk, "mandelbrot", (re_min, re_max, im_min, im_max), res, opts,
+                        keep_state and _resumable(opts), (aa, aa_tol, aa_seed) if aa else None, de)
+        data = disk.get(key)
+        if data is not None:
+            return data
+    if opts['precision'] == "perturb":
+        data = mandelbrot_perturb(re_min, re_max, im_min, im_max, max_betr, opts['max_iter'], res, cont,
+                                  keep_mag2=keep_mag2, cancel=cancel, deadline=deadline,
+                                  progress=progress)
+        if disk is not None and data is not None and data.complete:
+            disk.put(key, data)
+        return data
+    if aa:
+        keep_state, prev = False, None
+    state = [] if keep_state and _resumable(opts) else None
+    watch = _watch(cancel, deadline, progress, x.shape[-1] * y.shape[-1])
+    try:
+        img, stats = _render_prev(x, y, opts, workers, tile, prev, state, watch)
+        if aa and not watch.expired:
+            edges = _antialias(img, x, y, opts, aa, aa_tol, aa_seed, cancel)
+    except _cancelled:
+        return None
+
+    calc_t = time.time()-start_t
+
+    # The stats of the anti-aliased image are calculated when used
+    data = _fractal(img, calc_t, opts, None if aa else stats)
+    data.extent = (re_min, re_max, im_min, im_max)
+    data.periodic = stats.periodic
+    if de:
+        data.de = _distance_image(data, x, y)
+    if watch.expired:
+        # The missing pixels can't be continued or reused
+        data.complete = False
+        return data
+    if aa:
+        data.antialiased = edges
+    else:
+        data.opts = opts
+        if state is not None:
+            data.state = _state(state, data.data.shape, opts)
+    if disk is not None:
+        disk.put(key, data)
+    return data
+
+#
+# Anti-aliasing of the image img (see _layers) on the float pixel axes x and y:
+# the pixels whose log escape value differs by more than <tol> from one of their
+# four neighbours get k*k samples, jittered on a k*k grid over the pixel by a
+# RandomState with the <seed>. Interior points count as escaping at max_iter,
+# so the border of the set next to slowly escaping points isn't an edge.
+# The samples of the four corner cells of the grid are calculated first, the
+# others only if these don't agree (all interior or within <tol> in log space).
+# A pixel is interior if most of its samples are, otherwise it gets the mean of
+# its escaped samples, so interior samples don't pull it to a lower value.
+# The samples are calculated in batches of about <batch>, <cancel> is checked
+# before every batch (see _check). With the option mag2 |z|^2 of those pixels
+# is set to 0, so fractal_data.values() leaves the means as they are. Returns
+# the number of pixels anti-aliased.
+#
+def _antialias(img, x, y, opts, k, tol=0.3, seed=0, cancel=None, batch=2**18):
+    v = img[0] if opts['mag2'] else img
+    lv = np.log(np.where(v > 0, v, opts['max_iter']))
+    edge = np.zeros(v.shape, dtype=bool)
+    d = abs(np.diff(lv, axis=0)) > tol
+    edge[1:] |= d
+    edge[:-1] |= d
+    d = abs(np.diff(lv, axis=1)) > tol
+    edge[:, 1:] |= d
+    edge[:, :-1] |= d
+    px, py = np.nonzero(edge)
+    # Pixel pitch of the axes
+    sx = (x[-1] - x[0]) / max(1, len(x)-1)
+    sy = (y[-1] - y[0]) / max(1, len(y)-1)
+    rnd = np.random.RandomState(seed)
+    # Cell of every sample on the k*k grid, the corner cells first
+    gx, gy = np.divmod(np.arange(k*k), k)
+    corner = ((gx == 0) | (gx == k-1)) & ((gy == 0) | (gy == k-1))
+    order = np.argsort(~corner, kind='mergesort')
+    gx, gy, m = gx[order], gy[order], corner.sum()
+    sample = dict(opts, mag2=False)
+    n = max(1, batch // (k*k))
+    means = np.zeros(len(px), dtype=v.dtype)
+    for s in range(0, len(px), n):
+        _check(cancel)
+        bx, by = px[s:s+n], py[s:s+n]
+        ox = (gx + rnd.random_sample((len(bx), k*k))) / k - 0.5
+        oy = (gy + rnd.random_sample((len(bx), k*k))) / k - 0.5
+        c = (x[bx, None] + ox*sx) + complex(0,1)*(y[by, None] + oy*sy)
+        out = np.zeros(c.shape, dtype=v.dtype)
+        out[:, :m] = _calc(c[:, :m].ravel(), sample)[0].reshape(-1, m)
+        # Samples taken of every pixel
+        taken = np.full(len(bx), m)
+        lc = np.log(np.where(out[:, :m] > 0, out[:, :m], opts['max_iter']))
+        more = np.flatnonzero((lc.max(axis=1) - lc.min(axis=1) > tol) |
+                              ((out[:, :m] > 0).any(axis=1) & (out[:, :m] <= 0).any(axis=1)))
+        if m < k*k and len(more):
+            out[more, m:] = _calc(c[more, m:].ravel(), sample)[0].reshape(len(more), -1)
+            taken[more] = k*k
+        esc = (out > 0) & (np.arange(k*k) < taken[:, None])
+        mean = np.where(esc, out, 0).sum(axis=1) / np.maximum(esc.sum(axis=1), 1)
+        means[s:s+n] = np.where(2*esc.sum(axis=1) > taken, mean, 0)
+    v[px, py] = means
+    if opts['mag2']:
+        img[1, px, py] = 0
+    return len(px)
+
+#
+# Distance estimate (see _distance) of the escaped pixels of the fractal_data
+# <data> with mag2 on the float pixel axes x and y, in units of the pixel pitch
+#
+def _distance_image(data, x, y):
+    de = np.zeros(data.data.shape)
+    it = _iterations(data.data, data.mag2, data.cont)
+    px, py = np.nonzero(it > 0)
+    pitch = (x[-1] - x[0]) / max(1, len(x)-1)
+    de[px, py] = _distance(x[px] + complex(0,1)*y[py], it[px, py]) / pitch
+    return de
+
+#
+# fractal_data of the image img calculated with the options opts, see _layers.
+# Without the escape_stats <stats> they are calculated from img when used.
+#
+def _fractal(img, calc_t, opts, stats=None):
+    mag2 = None
+    if opts['mag2']:
+        img, mag2 = img
+    data = fractal_data(img, calc_t, shape=img.shape, datatype=img.dtype, stats=stats)
+    data.mag2 = mag2
+    data.max_iter = opts['max_iter']
+    if stats is not None:
+        data.periodic = stats.periodic
+    data.cont = opts['cont']
+    data.precision = opts['precision']
+    return data
+
+#
+# Whether the iteration of a render with the options opts can be continued
+#
+def _resumable(opts):
+    return opts['mode'] == "brute" and opts['precision'] in ("single", "double")
+
+#
+# fractal_data.state from the (px, py, z, c) parts of _calc_at for an image of
+# <shape>: flat pixel index, z and c of the points still alive after the
+# iterations done and the options to continue them with
+#
+def _state(parts, shape, opts):
+    if not parts:
+        z = np.zeros(0, dtype=np.result_type(opts['dtype'], np.complex64))
+        parts = [(np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), z, z.astype(complex))]
+    px, py, z, c = [np.concatenate(a) for a in zip(*parts)]
+    return dict(idx=px*shape[1] + py, z=z, c=c, iter=opts['max_iter'], opts=opts)
+
+#
+# Continues the iteration of a fractal_data calculated with keep_state up to
+# the higher <max_iter>, only the points still alive are iterated further.
+# Returns a new fractal_data with the same image as calculated with max_iter
+# directly (the periodicity check may retire other points), which can be
+# continued again. The points are continued in batches of <batch>, for
+# <cancel>, <deadline> and <progress> see mandelbrot(), they are checked after
+# every batch. Once the deadline has passed the points not continued are -1,
+# fractal_data.complete is False and there is no state to continue.
+#
+def mandelbrot_resume(data, max_iter, cancel=None, deadline=None, progress=None, batch=2**16):
+    # Save Startime
+    start_t = time.time()
+    st = data.state
+    if st is None:
+        raise ValueError("No iteration state, calculate with keep_state=True")
+    if max_iter < st['iter']:
+        raise ValueError("max_iter is below the %d iterations done" % st['iter'])
+    opts = dict(st['opts'], max_iter=max_iter)
+    n = len(st['idx'])
+    out = np.zeros(_layers(opts) + (n,), dtype=opts['dtype'])
+    live = []
+    stats = escape_stats()
+    watch = _watch(cancel, deadline, progress, n)
+    iterate = _backends[opts['backend']]
+    try:
+        for s in range(0, n, batch):
+            if not watch.check():
+                (out[0] if opts['mag2'] else out)[s:] = -1
+                break
+            part = []
+            stats += iterate(st['c'][s:s+batch], out[..., s:s+batch], opts['max_betr'], max_iter,
+                             opts['cont'], opts['period_tol'], z=st['z'][s:s+batch],
+                             start=st['iter'], state=part, cancel=cancel)
+            live += [(i + s, z) for i, z in part]
+            watch.advance(min(batch, n - s))
+    except _cancelled:
+        return None
+    img = np.array(data.data)
+    if opts['mag2']:
+        img = np.array([img, data.mag2])
+    img.reshape(_layers(opts) + (-1,))[..., st['idx']] = out
+
+    calc_t = time.time()-start_t
+
+    # The points still alive had the value 0 before
+    new = _fractal(img, calc_t, opts, data.stats + stats)
+    new.extent = data.extent
+    new.precision = data.precision
+    if watch.expired:
+        new.complete = False
+        return new
+    new.opts = opts
+    if live:
+        i, z = [np.concatenate(a) for a in zip(*live)]
+    else:
+        i, z = np.zeros(0, dtype=np.intp), st['z'][:0]
+    new.state = dict(idx=st['idx'][i], z=z, c=st['c'][i], iter=max_iter, opts=opts)
+    return new
+
+#
+# Chooses max_iter for a viewport from the escape rate of a probe with a
+# resolution of <probe> pixels: starting at <start> the iterations are doubled
+# (with mandelbrot_resume where possible) until a doubling lets at most <tol>
+# times the points escaped so far escape in addition, or no point is left which
+# could still escape. Interior points are found with the periodicity check, so
+# a viewport without escapes stops early. The iterations are capped at 256
+# times the fourth root of the magnification of the viewport (1024 for a width
+# of 0.01) and at <limit>. The probes of "dd" and "perturb" can't be resumed
+# and have no periodicity check, so they start at the iteration where the
+# orbit of the center escapes (see _center_orbit) and stop without escapes if
+# the center is interior.
+# <res> and <precision> are those of the render, "single" is probed in "double".
+# If <cancel> gets set, the probe stops and None is returned, see mandelbrot().
+#
+def auto_iter(re_min, re_max, im_min, im_max, max_betr, res=400, precision="auto", probe=64,
+              start=64, limit=2**16, tol=0.02, cancel=None):
+    if precision == "auto":
+        precision = _precision(re_min, re_max, res)
+    if precision == "single":
+        precision = "double"
+    width = float(Decimal(re_max) - Decimal(re_min))
+    limit = min(limit, 2**(8 + max(0, int(math.log(4 / width, 2))) // 4))
+    args = (re_min, re_max, im_min, im_max, max_betr)
+    n = start
+    interior = False
+    if precision in ("dd", "perturb"):
+        try:
+            k, interior = _center_orbit(re_min, re_max, im_min, im_max, max_betr, limit, cancel)
+        except _cancelled:
+            return None
+        while n < k and not interior:
+            n *= 2
+    data = mandelbrot(*args + (n, probe), period_tol=1e-10, precision=precision, keep_state=True,
+                      cancel=cancel)
+    while n < limit and data is not None:
+        if data.state is None:
+            if interior and not data.stats.count:
+                break
+            new = mandelbrot(*args + (2*n, probe), precision=precision, cancel=cancel)
+        elif len(data.state['idx']):
+            new = mandelbrot_resume(data, 2*n, cancel)
+        else:
+            break
+        if new is None:
+            return None
+        n *= 2
+        # Points which escaped in this doubling
+        escaped = new.stats.count - data.stats.count
+        data = new
+        if data.stats.count and escaped <= tol * (data.stats.count - escaped):
+            break
+    if data is None:
+        return None
+    return n
+
+#
+# Iterations after which the orbit of the center of the viewport escapes (<n>
+# if it doesn't) and whether it is interior, i.e. ends in a cycle. The orbit is
+# calculated with Decimals like a reference orbit, see _reference_orbit, and
+# aborted on <cancel> (see _check).
+#
+def _center_orbit(re_min, re_max, im_min, im_max, max_betr, n, cancel=None):
+    re_min, re_max, im_min, im_max = [Decimal(v) for v in (re_min, re_max, im_min, im_max)]
+    with localcontext() as ctx:
+        # Enough digits to resolve the width of the viewport
+        ctx.prec = max(30, int(-math.log10(float(re_max - re_min))) + 25)
+        Z = _reference_orbit((re_min + re_max) / 2, (im_min + im_max) / 2, max_betr, n, _watch(cancel))
+    if len(Z) <= n:
+        return len(Z) - 1, False
+    return n, bool((abs(Z[-4097:-1] - Z[-1]) < 1e-10).any())
+
+#
+# Checks the render options, resolves max_iter="auto" (see auto_iter), the
+# precision and the backend and returns the pixel axes x and y (the
+# values of the pixel rows and columns) for it. Raises _cancelled if <cancel>
+# gets set while max_iter is chosen.
+#
+def _setup(re_min, re_max, im_min, im_max, res, opts, cancel=None):
+    if opts['mode'] not in ("brute", "subdivide", "de"):
+        raise ValueError("Unknown mode: %s" % opts['mode'])
+    if opts['max_iter'] == "auto":
+        opts['max_iter'] = auto_iter(re_min, re_max, im_min, im_max, opts['max_betr'], res,
+                                     opts['precision'], cancel=cancel)
+        if opts['max_iter'] is None:
+            raise _cancelled()
+    if opts['precision'] == "auto":
+        opts['precision'] = _precision(re_min, re_max, res, opts['max_iter'])
+    precision = opts['precision']
+    if precision not in ("single", "double", "dd", "perturb"):
+        raise ValueError("Unknown precision: %s" % precision)
+    opts['dtype'] = np.float32 if precision == "single" else np.float64
+    opts['backend'] = _backend(opts['backend'])
+    if opts['mode'] == "de" and precision not in ("single", "double"):
+        opts['mode'] = "brute"
+    if precision == "perturb":
+        return None, None
+    if precision == "dd":
+        return _axes_dd(re_min, re_max, im_min, im_max, res)
+    re_min, re_max, im_min, im_max = [float(v) for v in (re_min, re_max, im_min, im_max)]
+    return _axes(re_min, re_max, im_min, im_max, res)
+
+#
+# Generator version of mandelbrot() which yields a preview at 1/8, 1/4 and 1/2
+# of the resolution before the full image. Every level (pixel step) has to
+# divide the one before and only calculates the pixels between those of the
+# coarser level, the preview fills the pixels
+# between with their calculated neighbour (fractal_data.level is the pixel
+# step). The final image is the same as from mandelbrot().
+# If <cancel> gets set, no more levels are yielded, see mandelbrot(). Once the
+# <deadline> has passed the level being calculated is yielded with the pixels
+# not done at -1 and fractal_data.complete False, and no more levels follow.
+# progress(done, total) counts the pixels of all levels together.
+#
+def mandelbrot_progressive(re_min, re_max, im_min, im_max, max_betr, max_iter, res=400, cont=False,
+                           workers=1, tile=128, reject=True, period_tol=None, mode="brute",
+                           precision="auto", levels=(8, 4, 2, 1), cancel=None, keep_mag2=False,
+                           backend="auto", deadline=None, progress=None):
+    # Save Startime
+    start_t = time.time()
+    opts = dict(max_betr=max_betr, max_iter=max_iter, cont=cont, reject=reject,
+                period_tol=period_tol, mode=mode, precision=precision, mag2=keep_mag2,
+                backend=backend)
+    try:
+        x, y = _setup(re_min, re_max, im_min, im_max, res, opts, cancel)
+    except _cancelled:
+        return
+    if opts['precision'] == "perturb":
+        for data in _progressive_perturb(re_min, re_max, im_min, im_max, res, opts, levels, cancel,
+                                         deadline, progress):
+            yield data
+        return
+
+    shape = (x.shape[-1], y.shape[-1])
+    # The levels together calculate every pixel once
+    watch = _watch(cancel, deadline, progress, shape[0] * shape[1])
+    coarse = None
+    last = None
+    stats = escape_stats()
+    for s in levels:
+        try:
+            if coarse is None:
+                coarse, stats = _render(x[..., ::s], y[..., ::s], opts, workers, tile, None, watch)
+            else:
+                # Every r-th row and column of this level is in the coarser level
+                r = last // s
+                img = np.zeros(coarse.shape[:-2] + (len(range(0, shape[0], s)), len(range(0, shape[1], s))),
+                               dtype=coarse.dtype)
+                img[..., ::r, ::r] = coarse
+                for a in range(1, r):
+                    img[..., a::r, :], p = _render(x[..., a*s::last], y[..., ::s], opts, workers, tile,
+                                              None, watch)
+                    stats += p
+                    img[..., ::r, a::r], p = _render(x[..., ::last], y[..., a*s::last], opts, workers, tile,
+                                                None, watch)
+                    stats += p
+                coarse = img
+        except _cancelled:
+            return
+        last = s
+        preview = np.repeat(np.repeat(coarse, s, -2), s, -1)[..., :shape[0], :shape[1]]
+
+        # The levels together calculate every pixel once, so the stats only
+        # hold for the final image and those of the previews are their own
+        data = _fractal(preview, time.time()-start_t, opts, stats if s == 1 else None)
+        data.extent = (re_min, re_max, im_min, im_max)
+        data.periodic = stats.periodic
+        data.level = s
+        if watch.expired:
+            data.complete = False
+            yield data
+            return
+        if s == 1:
+            data.opts = opts
+        yield data
+
+#
+# mandelbrot_progressive() for the precision "perturb": the levels are rendered
+# separately by mandelbrot_perturb() with the resolution res/s, so the previews
+# are cheap, and scaled up to the image size by repeating their pixels.
+# progress(done, total) counts the pixels of all levels together.
+#
+def _progressive_perturb(re_min, re_max, im_min, im_max, res, opts, levels, cancel, deadline=None,
+                         progress=None):
+    re_min, re_max, im_min, im_max = [Decimal(v) for v in (re_min, re_max, im_min, im_max)]
+    # Pixels along Im(c) for the resolution r, as in mandelbrot_perturb()
+    cols = lambda r: int(round(r / float(re_max - re_min) * float(im_max - im_min)))
+    shape = (res, cols(res))
+    sizes = [max(2, res // s) * cols(max(2, res // s)) for s in levels]
+    for k, s in enumerate(levels):
+        level_progress = None
+        if progress is not None:
+            level_progress = lambda n, total, done=sum(sizes[:k]): progress(done + n, sum(sizes))
+        data = mandelbrot_perturb(re_min, re_max, im_min, im_max, opts['max_betr'], opts['max_iter'],
+                                  max(2, res // s), opts['cont'], keep_mag2=opts['mag2'], cancel=cancel,
+                                  deadline=deadline, progress=level_progress)
+        if data is None:
+            return
+        if s > 1:
+            # Nearest pixel of the preview for every pixel of the image
+            ix = np.arange(shape[0]) * data.data.shape[0] // shape[0]
+            iy = np.arange(shape[1]) * data.data.shape[1] // shape[1]
+            data.data = data.data[ix][:, iy]
+            if data.mag2 is not None:
+                data.mag2 = data.mag2[ix][:, iy]
+        data.level = s
+        yield data
+        if not data.complete:
+            return
+
+#
+# Bytes of the arrays (and escape_stats) in a (nested) tuple
+#
+def _nbytes(v):
+    if v is None:
+        return 0
+    if isinstance(v, tuple):
+        return sum(_nbytes(a) for a in v)
+    if isinstance(v, escape_stats):
+        return v.hist.nbytes
+    return v.nbytes
+
+#
+# Least recently used cache of image tiles with a budget in bytes, a tile can
+# be any array or tuple of arrays. It can be shared by threads, e.g. a render
+# still running after a cancel and the next one.
+#
+class tile_cache():
+        def __init__(self, budget=256*2**20, size=64):
+            self.budget = budget
+            # Edge length of a tile in pixels
+            self.size = size
+            self.nbytes = 0
+            self.tiles = OrderedDict()
+            self.lock = threading.Lock()
+
+        def get(self, key):
+            with self.lock:
+                tile = self.tiles.pop(key, None)
+                if tile is not None:
+                    # Move to the most recently used end
+                    self.tiles[key] = tile
+                return tile
+
+        def put(self, key, tile):
+            n = _nbytes(tile)
+            with self.lock:
+                old = self.tiles.pop(key, None)
+                if old is not None:
+                    self.nbytes -= _nbytes(old)
+                self.tiles[key] = tile
+                self.nbytes += n
+                # Evict the least recently used tiles
+                while self.nbytes > self.budget and len(self.tiles) > 1:
+                    self.nbytes -= _nbytes(self.tiles.popitem(last=False)[1])
+
+#
+# Cache of rendered images in the directory <path> shared by processes and
+# sessions, with a budget in bytes. An image is a compressed .npz file named by
+# the hash of its render arguments (see key()), the least recently used ones are
+# removed when the budget is exceeded. Images are written to a temporary file
+# and renamed, so a reader never sees a partial file. "key in cache" checks if
+# an image is there without loading it.
+#
+class disk_cache():
+        def __init__(self, path, budget=2**30):
+            self.path = path
+            self.budget = budget
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+        #
+        # Hash of the render arguments <parts>, their repr() has to be unique
+        #
+        def key(self, *parts):
+            return hashlib.sha1(repr((_disk_version,) + parts).encode()).hexdigest()
+
+        def file(self, key):
+            return os.path.join(self.path, key + ".npz")
+
+        def __contains__(self, key):
+            return os.path.exists(self.file(key))
+
+        #
+        # fractal_data of the image with the <key> or None if it isn't cached,
+        # calc_time is the time to load it
+        #
+        def get(self, key):
+            start_t = time.time()
+            path = self.file(key)
+            try:
+                f = np.load(path)
+                try:
+                    arrays = dict((name, f[name]) for name in f.files)
+                finally:
+                    f.close()
+                # Mark it as recently used
+                os.utime(path, None)
+            except (IOError, OSError, ValueError):
+                # Not cached or removed meanwhile
+                return None
+            meta = json.loads(arrays.pop('meta')[()])
+            img = arrays.pop('data')
+            data = fractal_data(img, 0, shape=img.shape, datatype=img.dtype)
+            for name, v in meta['attrs'].items():
+                setattr(data, name, v)
+            data.extent = tuple(v if isinstance(v, float) else Decimal(v) for v in meta['extent'])
+            data.opts = _json_opts(meta['opts'], load=True)
+            data.mag2 = arrays.get('mag2')
+            data.de = arrays.get('de')
+            if meta['state'] is not None:
+                st = meta['state']
+                data.state = dict(idx=arrays['state_idx'], z=arrays['state_z'], c=arrays['state_c'],
+                                  iter=st['iter'], opts=_json_opts(st['opts'], load=True))
+            data.calc_time = time.time()-start_t
+            return data
+
+        #
+        # Saves the complete fractal_data <data> with the <key>
+        #
+        def put(self, key, data):
+            arrays = dict(data=np.asarray(data.data))
+            for name in ('mag2', 'de'):
+                if getattr(data, name) is not None:
+                    arrays[name] = getattr(data, name)
+            attrs = dict((name, data.__dict__[name]) for name in _disk_attrs if name in data.__dict__)
+            state = data.state
+            if state is not None:
+                arrays.update(state_idx=state['idx'], state_z=state['z'], state_c=state['c'])
+                state = dict(iter=state['iter'], opts=_json_opts(state['opts']))
+            meta = dict(attrs=attrs, extent=data.extent, opts=_json_opts(data.opts), state=state)
+            arrays['meta'] = np.array(json.dumps(meta, default=_json))
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, **arrays)
+                # Atomic, a concurrent writer of the same key wrote the same image
+                getattr(os, "replace", os.rename)(tmp, self.file(key))
+            except:
+                os.remove(tmp)
+                raise
+            self.evict()
+
+        #
+        # Removes the least recently used images until the budget is kept,
+        # and temporary files left by processes which died while writing
+        #
+        def evict(self):
+            files = []
+            now = time.time()
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                    if name.endswith(".tmp") and st.st_mtime < now - 3600:
+                        os.remove(path)
+                except OSError:
+                    # Removed by another process
+                    continue
+                if name.endswith(".npz"):
+                    files.append((st.st_mtime, st.st_size, path))
+            files.sort()
+            nbytes = sum(f[1] for f in files)
+            # The newest image is kept even if it exceeds the budget
+            for mtime, size, path in files[:-1]:
+                if nbytes <= self.budget:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                nbytes -= size
+
+# Version of the disk_cache format and engine, part of every key
+_disk_version = 1
+# Scalar attributes of fractal_data kept in the disk_cache
+_disk_attrs = ("precision", "max_iter", "periodic", "references", "skipped", "glitched", "cont",
+               "antialiased")
+
+#
+# JSON encoding of numpy scalars and Decimals
+#
+def _json(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, Decimal):
+        return str(v)
+    raise TypeError("Can't encode %r" % (v,))
+
+#
+# Render options with the dtype to a JSON compatible form and back with <load>
+#
+def _json_opts(opts, load=False):
+    if opts is None:
+        return None
+    if load:
+        return dict(opts, dtype=np.dtype(opts['dtype']).type)
+    return dict(opts, dtype=np.dtype(opts['dtype']).name)
+
+#
+# disk_cache key of an image of <engine> with the options opts after _setup and
+# the <extra> arguments changing it. The extent is normalized, so the same
+# viewport given as strings or numbers has the same key.
+#
+def _disk_key(disk, engine, extent, res, opts, *extra):
+    if opts['precision'] in ("single", "double"):
+        extent = tuple(float(v) for v in extent)
+    else:
+        extent = tuple(str(Decimal(v)) for v in extent)
+    return disk.key(engine, extent, res, opts['max_betr'], opts['max_iter'], opts['cont'],
+                    opts['reject'], opts['period_tol'], opts['mode'], opts['precision'],
+                    opts['mag2'], extra)
+
+#
+# Rectangles (tx0, tx1, ty0, ty1, tiles) covering the (tx, ty, key) <tiles>
+# exactly: runs of consecutive tiles in a column, merged with the runs of the
+# next columns which span the same rows. A full viewport is one rectangle.
+#
+def _rects(tiles):
+    runs = []
+    for t in sorted(tiles, key=lambda t: t[:2]):
+        if runs and runs[-1][0] == t[0] and runs[-1][2] == t[1]:
+            runs[-1][2] += 1
+            runs[-1][3].append(t)
+        else:
+            runs.append([t[0], t[1], t[1]+1, [t]])
+    rects = []
+    for tx, ty0, ty1, run in runs:
+        for r in rects:
+            if r[1] == tx and r[2:4] == [ty0, ty1]:
+                r[1] += 1
+                r[4].extend(run)
+                break
+        else:
+            rects.append([tx, tx+1, ty0, ty1, run])
+    return rects
+
+#
+# Renders the viewport from the tiles of a tile_cache, only the missing tiles
+# are calculated. The pixels lie on a global lattice with the pitch 2^(-z/4) of
+# zoom level z, so tiles can be shared between viewports. The viewport is
+# snapped outwards to the lattice, see fractal_data.extent, and the resolution
+# is up to 19% higher than <res>. fractal_data.cached is the number of tiles
+# taken from the tile_cache <cache> (None: a new one for this call). The missing
+# tiles are calculated in rectangles which contain no cached tile, see _rects,
+# cut to the viewport. The tiles cut by the viewport are calculated and cached
+# in part, a viewport which needs more of them calculates them again, copying
+# the pixels of <prev>.
+# With compute=False None is returned unless all tiles are cached. Precisions
+# beyond "double" are calculated with mandelbrot() directly.
+# With <keep_state> the tiles keep their iteration state, see mandelbrot(), and
+# tiles cached without it are calculated again. Missing tiles copy the pixels
+# on their grid from <prev>, see mandelbrot(). None is also returned if
+# <cancel> gets set. Once the <deadline> has passed the missing tiles not done
+# are -1 and neither cached nor kept in the state, fractal_data.complete is
+# False. progress(done, total) counts the pixels of the missing tiles.
+# A viewport in the disk_cache <disk> is taken from it even with
+# compute=False, calculated ones are saved to it.
+# The other arguments are those of mandelbrot().
+#
+def mandelbrot_tiled(re_min, re_max, im_min, im_max, max_betr, max_iter, res=400, cont=False,
+                     cache=None, compute=True, workers=1, tile=128, reject=True, period_tol=None,
+                     mode="brute", precision="auto", keep_state=False, prev=None, cancel=None,
+                     keep_mag2=False, backend="auto", disk=None, deadline=None, progress=None):
+    # Save Startime
+    start_t = time.time()
+    opts = dict(max_betr=max_betr, max_iter=max_iter, cont=cont, reject=reject,
+                period_tol=period_tol, mode=mode, precision=precision, mag2=keep_mag2,
+                backend=backend)
+    try:
+        _setup(re_min, re_max, im_min, im_max, res, opts, cancel)
+    except _cancelled:
+        return None
+    max_iter = opts['max_iter']
+    if cache is None:
+        cache = tile_cache()
+    if opts['precision'] in ("dd", "perturb"):
+        if not compute:
+            if disk is None:
+                return None
+            key = _disk_key(disk, "mandelbrot", (re_min, re_max, im_min, im_max), res, opts,
+                            keep_state and _resumable(opts), None, False)
+            return disk.get(key)
+        return mandelbrot(re_min, re_max, im_min, im_max, max_betr, max_iter, res, cont,
+                          workers, tile, reject, period_tol, mode, opts['precision'], keep_state, prev,
+                          cancel, deadline, progress, keep_mag2=keep_mag2, backend=backend, disk=disk)
+    if disk is not None:
+        disk_key = _disk_key(disk, "tiled", (re_min, re_max, im_min, im_max), res, opts,
+                             keep_state and _resumable(opts), cache.size)
+        data = disk.get(disk_key)
+        if data is not None:
+            return data
+
+    re_min, re_max, im_min, im_max = [float(v) for v in (re_min, re_max, im_min, im_max)]
+    # Finest zoom level whose pitch is at most the one asked for
+    z = int(math.ceil(4 * math.log((res-1) / (re_max - re_min), 2)))
+    p = 2.0**(-z/4.0)
+    i0, i1 = int(math.floor(re_min / p)), int(math.ceil(re_max / p))
+    j0, j1 = int(math.floor(im_min / p)), int(math.ceil(im_max / p))
+    size = cache.size
+    keep = keep_state and _resumable(opts)
+
+    # The cached tiles are (image, state, escape_stats, bounds), the state
+    # (index in the tile, z, c), the bounds (x0, x1, y0, y1) of the part
+    # calculated, in the tile
+    tiles = {}
+    missing = []
+    for tx in range(i0 // size, i1 // size + 1):
+        for ty in range(j0 // size, j1 // size + 1):
+            key = (z, tx, ty, max_iter, max_betr, cont, reject, period_tol, mode, opts['precision'],
+                   keep_mag2)
+            tiles[tx, ty] = t = cache.get(key)
+            if t is not None:
+                # Part of the tile in the viewport
+                x0, y0 = max(i0 - tx*size, 0), max(j0 - ty*size, 0)
+                x1, y1 = min(i1+1 - tx*size, size), min(j1+1 - ty*size, size)
+                b = t[3]
+                covered = b[0] <= x0 and b[1] >= x1 and b[2] <= y0 and b[3] >= y1
+            if t is None or not covered or (keep and t[1] is None):
+                missing.append((tx, ty, key))
+    cached = len(tiles) - len(missing)
+    if missing and not compute:
+        return None
+
+    periodic = 0
+    # The rectangles are cut to the viewport, the tiles cut by it are only
+    # calculated in part and not cached
+    rects = [(max(i0, tx0*size), min(i1+1, tx1*size), max(j0, ty0*size), min(j1+1, ty1*size), block)
+             for tx0, tx1, ty0, ty1, block in _rects(missing)]
+    watch = _watch(cancel, deadline, progress, sum((a1-a0) * (b1-b0) for a0, a1, b0, b1, _ in rects))
+    for a0, a1, b0, b1, block in rects:
+        if watch.expired:
+            for tx, ty, key in block:
+                tiles[tx, ty] = (np.full(_layers(opts) + (size, size), -1, dtype=opts['dtype']), None,
+                                 escape_stats(), None)
+            continue
+        x = np.arange(a0, a1) * p
+        y = np.arange(b0, b1) * p
+        state = [] if keep else None
+        try:
+            img, stats = _render_prev(x, y, opts, workers, tile, prev, state, watch)
+        except _cancelled:
+            return None
+        # Tiles of the rectangle
+        tx0, ty0 = a0 // size, b0 // size
+        ny = (b1-1) // size - ty0 + 1
+        if keep:
+            # Sort the points alive by their tile
+            st = _state(state, img.shape[-2:], opts)
+            px, py = np.divmod(st['idx'], img.shape[-1])
+            px += a0
+            py += b0
+            t = (px // size - tx0) * ny + py // size - ty0
+            order = np.argsort(t, kind='mergesort')
+            t = t[order]
+        periodic += stats.periodic
+        for tx, ty, key in block:
+            c0, c1 = max(a0, tx*size), min(a1, (tx+1)*size)
+            d0, d1 = max(b0, ty*size), min(b1, (ty+1)*size)
+            part = np.zeros(_layers(opts) + (size, size), dtype=opts['dtype'])
+            part[..., c0-tx*size:c1-tx*size, d0-ty*size:d1-ty*size] = img[..., c0-a0:c1-a0, d0-b0:d1-b0]
+            part_state = None
+            if keep:
+                k = (tx-tx0)*ny + ty-ty0
+                sel = order[np.searchsorted(t, k):np.searchsorted(t, k, 'right')]
+                part_state = ((px[sel] % size)*size + py[sel] % size, st['z'][sel], st['c'][sel])
+            bounds = np.array([c0, c1, d0, d1]) - [tx*size, tx*size, ty*size, ty*size]
+            tiles[tx, ty] = (part, part_state, _stats(part[0] if keep_mag2 else part), bounds)
+            if not watch.expired:
+                cache.put(key, tiles[tx, ty])
+        del img
+
+    # Assemble the viewport from the overlapping parts of the tiles
+    img = np.zeros(_layers(opts) + (i1-i0+1, j1-j0+1), dtype=opts['dtype'])
+    # Escape values of the viewport
+    v = img[0] if keep_mag2 else img
+    parts = []
+    stats = escape_stats()
+    for (tx, ty), (t, t_state, t_stats, _) in tiles.items():
+        a0, a1 = max(i0, tx*size), min(i1+1, (tx+1)*size)
+        b0, b1 = max(j0, ty*size), min(j1+1, (ty+1)*size)
+        img[..., a0-i0:a1-i0, b0-j0:b1-j0] = t[..., a0-tx*size:a1-tx*size, b0-ty*size:b1-ty*size]
+        # Only the tiles cut by the viewport need a pass over their values
+        if (a1-a0, b1-b0) == (size, size):
+            stats += t_stats
+        else:
+            stats += _stats(v[a0-i0:a1-i0, b0-j0:b1-j0])
+        if keep and not watch.expired:
+            ti, tz, tc = t_state
+            a, b = tx*size + ti // size, ty*size + ti % size
+            m = (a >= i0) & (a <= i1) & (b >= j0) & (b <= j1)
+            parts.append((a[m]-i0, b[m]-j0, tz[m], tc[m]))
+
+    calc_t = time.time()-start_t
+
+    data = _fractal(img, calc_t, opts, stats)
+    data.extent = (i0*p, i1*p, j0*p, j1*p)
+    data.periodic = periodic
+    data.cached = cached
+    if watch.expired:
+        data.complete = False
+        return data
+    data.opts = opts
+    if keep:
+        data.state = _state(parts, data.data.shape, opts)
+    if disk is not None:
+        disk.put(disk_key, data)
+    return data
+
+#
+# Renders an image too big for the memory in bands of Re(c) rows into the .npy
+# file <path>, which is returned as a memory mapped fractal_data. A band takes
+# at most <mem_limit> bytes and is appended to the file once it is done, so the
+# memory use doesn't grow with the image.
+# <cancel>, <deadline> and <progress> work as in mandelbrot(), the bands after
+# the deadline are written as -1. If <cancel> gets set, None is returned and
+# the file is incomplete.
+# The other arguments are those of mandelbrot(), "perturb" is not supported.
+#
+def mandelbrot_bands(re_min, re_max, im_min, im_max, max_betr, max_iter, path, res=400, cont=False,
+                     workers=1, tile=128, reject=True, period_tol=None, mode="brute",
+                     precision="auto", mem_limit=256*2**20, progress=None, backend="auto",
+                     cancel=None, deadline=None):
+    # Save Startime
+    start_t = time.time()
+    opts = dict(max_betr=max_betr, max_iter=max_iter, cont=cont, reject=reject,
+                period_tol=period_tol, mode=mode, precision=precision, mag2=False,
+                backend=backend)
+    try:
+        x, y = _setup(re_min, re_max, im_min, im_max, res, opts, cancel)
+    except _cancelled:
+        return None
+    if opts['precision'] == "perturb":
+        raise ValueError("Precision perturb is not supported for bands")
+
+    shape = (x.shape[-1], y.shape[-1])
+    dtype = np.dtype(opts['dtype'])
+    # Rows per band, the band image is counted twice for its temporaries
+    rows = max(1, int(mem_limit // (shape[1] * 2 * dtype.itemsize)))
+    stats = escape_stats()
+    watch = _watch(cancel, deadline, progress, shape[0] * shape[1])
+    f = open(path, 'wb')
+    try:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                 'fortran_order': False, 'shape': shape})
+        for b0 in range(0, shape[0], rows):
+            b1 = min(b0 + rows, shape[0])
+            if watch.expired:
+                band = np.full((b1-b0, shape[1]), -1, dtype=dtype)
+            else:
+                band, s = _render(x[..., b0:b1], y, opts, workers, tile, None, watch)
+                stats += s
+            # The bands are contiguous in the file, so they are just appended
+            band.tofile(f)
+            del band
+    except _cancelled:
+        return None
+    finally:
+        f.close()
+    img = np.load(path, mmap_mode='r')
+
+    calc_t = time.time()-start_t
+
+    data = _fractal(img, calc_t, opts, stats)
+    data.extent = (re_min, re_max, im_min, im_max)
+    data.complete = not watch.expired
+    return data
+
+#
+# Orbit Z_0 = 0, Z_n+1 = Z_n^2 + C of the reference point C in the precision of
+# the current decimal context, rounded to complex128. Stops after n iterations
+# or once the orbit escapes. The _watch <watch> is checked every <check>
+# iterations, once its deadline has passed the orbit is cut off there.
+#
+def _reference_orbit(cr, ci, max_betr, n, watch=None, check=1024):
+    Z = np.zeros(n+1, dtype=np.complex128)
+    zr = zi = Decimal(0)
+    b2 = Decimal(max_betr)*Decimal(max_betr)
+    for k in range(1, n+1):
+        if watch is not None and k % check == 0 and not watch.check():
+            return Z[:k]
+        zr, zi = zr*zr - zi*zi + cr, 2*zr*zi + ci
+        Z[k] = complex(float(zr), float(zi))
+        if zr*zr + zi*zi > b2:
+            return Z[:k+1]
+    return Z
+
+#
+# Series approximation delta_n = A_n*dc + B_n*dc^2 + C_n*dc^3 along the reference
+# orbit Z. The series is advanced while no point can escape and its truncation
+# error stays below <tol> of a pixel. The corner points of dc are iterated
+# directly as probes and the number of skipped iterations is halved until the
+# series matches them. Returns the number of skipped iterations and the deltas
+# at that iteration.
+#
+def _series(Z, dc, max_betr, max_iter, pitch, tol=1e-9):
+    r = np.abs(dc).max()
+    coef = [(0j, 0j, 0j)]
+    last = min(len(Z)-1, max_iter+1)
+    while len(coef) < last:
+        n = len(coef)-1
+        A, B, C = coef[n]
+        A1 = 2*Z[n]*A + 1
+        B1 = 2*Z[n]*B + A*A
+        C1 = 2*Z[n]*C + 2*A*B
+        if abs(C1)*r**3 > tol*abs(A1)*pitch:
+            break
+        if abs(Z[n+1]) + abs(A1)*r + abs(B1)*r**2 + abs(C1)*r**3 > max_betr:
+            break
+        coef.append((A1, B1, C1))
+
+    probes = dc[[np.argmin(dc.real), np.argmax(dc.real), np.argmin(dc.imag), np.argmax(dc.imag)]]
+    n = len(coef)-1
+    while n > 0:
+        d = np.zeros(len(probes), dtype=np.complex128)
+        for k in range(n):
+            d = (2*Z[k] + d)*d + probes
+        A, B, C = coef[n]
+        if (np.abs(d - ((C*probes + B)*probes + A)*probes) <= tol*abs(A)*pitch).all():
+            break
+        n //= 2
+    A, B, C = coef[n]
+    return n, ((C*dc + B)*dc + A)*dc
+
+#
+# Iterates the deltas dc to the reference orbit Z in complex128, starting with
+# the deltas d at iteration <start>. Points with |Z_n + delta_n| < glitch_tol*|Z_n|
+# lost their precision (glitch) and have to be calculated with another reference.
+# The _watch <watch> is checked every <check> iterations and advanced by the
+# points finished, once its deadline has passed the points still alive are
+# left at -1. Returns the escape values, the glitched points and their glitch
+# ratio.
+#
+def _perturb(dc, Z, max_betr, max_iter, cont, glitch_tol, start=0, d=None, layers=(), watch=None,
+             check=64):
+    if watch is None:
+        watch = _watch()
+    out = np.zeros(layers + (len(dc),), dtype=np.float64)
+    glitch = np.zeros(len(dc), dtype=bool)
+    ratio = np.ones(len(dc), dtype=np.float64)
+    idx = np.arange(len(dc))
+    if d is None:
+        d = np.zeros(len(dc), dtype=np.complex128)
+    b2 = max_betr*max_betr
+    g2 = glitch_tol*glitch_tol
+    events = []
+    # z_n+1 is the first value checked for escape, see _iterate
+    last = min(len(Z)-1, max_iter+1)
+    n = start
+    # Points escaped since the last check
+    done = 0
+    with np.errstate(over='ignore', invalid='ignore'):
+        while n < last and len(idx):
+            if (n - start) % check == 0:
+                watch.advance(done)
+                done = 0
+                if not watch.check():
+                    break
+            d = (2*Z[n] + d)*d + dc
+            n += 1
+            z = Z[n] + d
+            m = z.real*z.real + z.imag*z.imag
+            Zm = Z[n].real*Z[n].real + Z[n].imag*Z[n].imag
+            esc = ~(m <= b2) if n >= 2 else np.zeros(len(idx), dtype=bool)
+            g = ~esc & (m < g2*Zm)
+            if esc.any():
+                events.append((idx[esc], np.full(esc.sum(), n-1, dtype=np.int64), m[esc]))
+                done += np.count_nonzero(esc)
+            if g.any():
+                glitch[idx[g]] = True
+                ratio[idx[g]] = m[g] / Zm
+            rem = esc | g
+            if rem.any():
+                rem = ~rem
+                idx, d, dc = idx[rem], d[rem], dc[rem]
+    _save_escapes(out, events, cont)
+    if watch.expired:
+        out.reshape(-1, out.shape[-1])[:, idx] = 0
+        out.reshape(-1, out.shape[-1])[0, idx] = -1
+    elif n < max_iter+1:
+        # The reference escaped before these points, they need another reference
+        glitch[idx] = True
+    else:
+        done += len(idx)
+    watch.advance(done)
+    return out, glitch, ratio
+
+#
+# Calculates the mandelbrot set with perturbation theory for deep zooms.
+# The coordinates may be given as strings or Decimals beyond float64 precision.
+# One reference orbit is calculated with Decimal and all pixels are iterated as
+# complex128 deltas to it. Glitched pixels are calculated again with a new
+# reference chosen among them, up to <max_refs> references. With <series> the
+# first iterations are skipped by a series approximation. Rows which mirror
+# others at the real axis are copied from them. For <keep_mag2>, <cancel>,
+# <deadline> and <progress> see mandelbrot(), they are checked before every
+# reference orbit and during the iteration.
+#
+def mandelbrot_perturb(re_min, re_max, im_min, im_max, max_betr, max_iter, res=400, cont=False,
+                       series=False, glitch_tol=1e-3, max_refs=16, keep_mag2=False, cancel=None,
+                       deadline=None, progress=None):
+    # Save Startime
+    start_t = time.time()
+    re_min, re_max, im_min, im_max = [Decimal(v) for v in (re_min, re_max, im_min, im_max)]
+    pix_y = int(round(res / float(re_max - re_min) * float(im_max - im_min)))
     pix_x = res
-    px, py = np.mgrid[0:pix_x, 0:pix_y]
-    # x, y are the values of the pixels
-    x = np.linspace(re_min, re_max, pix_x)[px]
-    y = np.linspace(im_min, im_max, pix_y)[py]
-    c = x+complex(0,1)*y
-    # No need of these variables bacuase we only use c
-    del x,y
-    img = np.zeros(c.shape, dtype= np.float)
-    px.shape = py.shape = c.shape = pix_x*pix_y
-
-    z = np.copy(c)
-    for i in xrange(max_iter):
-        if not len(z): break;
-        np.multiply(z, z, z)
-        np.add(z, c, z)
-        # Create boolean array with all points that are bigger than <max_betr>
-        rem = abs(z)>max_betr
-        # Saves the value of <i+i> in img array for all escaped points
-        if cont: img[px[rem], py[rem]] = (i+ 1) - np.log( np.log(abs(z[rem]) ) / 2 / np.log(2) ) / np.log(2)
-        else: img[px[rem], py[rem]] = (i+ 1)
-        # invert boolean array
-        rem = -rem
-        # remove all escaped points
-        z = z[rem]
-        px, py = px[rem], py[rem]
-        c = c[rem]
+    if max_iter == "auto":
+        max_iter = auto_iter(re_min, re_max, im_min, im_max, max_betr, res, "perturb", cancel=cancel)
+        if max_iter is None:
+            return None
+    opts = dict(max_iter=max_iter, cont=cont, precision="perturb", mag2=keep_mag2)
+    img = np.zeros(_layers(opts) + (pix_x, pix_y), dtype=np.float64)
+    watch = _watch(cancel, deadline, progress, pix_x*pix_y)
+
+    try:
+        refs, skipped, todo = _perturb_refs(img, re_min, re_max, im_min, im_max, max_betr, opts, series,
+                                            glitch_tol, max_refs, watch)
+    except _cancelled:
+        return None
 
     calc_t = time.time()-start_t
 
-    data = fractal_data(img, calc_t, shape=img.shape, datatype=img.dtype)
+    data = _fractal(img, calc_t, opts)
+    data.extent = (re_min, re_max, im_min, im_max)
+    data.references = refs
+    data.skipped = skipped
+    data.glitched = len(todo)
+    data.complete = not watch.expired
     return data
+
+#
+# Iterates the pixels of the image img of mandelbrot_perturb() with up to
+# <max_refs> reference orbits, see there. The _watch <watch> is checked before
+# every reference, once its deadline has passed the glitched pixels are left
+# at -1. Returns the number of references used, the iterations skipped and the
+# flat indices of the pixels left glitched.
+#
+def _perturb_refs(img, re_min, re_max, im_min, im_max, max_betr, opts, series, glitch_tol, max_refs,
+                  watch):
+    pix_x, pix_y = img.shape[-2:]
+    px, py = np.mgrid[0:pix_x, 0:pix_y]
+    px.shape = py.shape = pix_x*pix_y
+    max_iter, cont = opts['max_iter'], opts['cont']
+    with localcontext() as ctx:
+        # Enough digits to resolve the pixel pitch
+        pitch = float(re_max - re_min) / pix_x
+        ctx.prec = max(30, int(-math.log10(pitch)) + 20)
+        sx = (re_max - re_min) / (pix_x-1)
+        sy = (im_max - im_min) / (pix_y-1)
+        # Rows which mirror others at the real axis are copied, see _mirror
+        mirror = _mirror(float(im_min / sy) + np.arange(pix_y))
+        todo = np.arange(pix_x*pix_y)
+        if mirror is not None:
+            todo = todo[~np.isin(py, mirror[0])]
+        # The first reference is the center pixel
+        kr, jr = pix_x//2, pix_y//2
+        refs = skipped = 0
+        while len(todo) and refs < max_refs:
+            if not watch.check():
+                # Pixels glitched by the last reference aren't calculated
+                img.reshape(_layers(opts) + (-1,))[..., todo] = 0
+                img.reshape(-1, pix_x*pix_y)[0, todo] = -1
+                todo = todo[:0]
+                break
+            Z = _reference_orbit(re_min + kr*sx, im_min + jr*sy, max_betr, max_iter+1, watch)
+            dc = (px[todo]-kr)*float(sx) + complex(0,1)*(py[todo]-jr)*float(sy)
+            start, d = 0, None
+            if series:
+                start, d = _series(Z, dc, max_betr, max_iter, float(sx))
+            out, glitch, ratio = _perturb(dc, Z, max_betr, max_iter, cont, glitch_tol, start, d,
+                                          _layers(opts), watch)
+            img.reshape(_layers(opts) + (-1,))[..., todo] = out
+            refs += 1
+            skipped = max(skipped, start)
+            # Next reference is the most glitched pixel
+            todo, ratio = todo[glitch], ratio[glitch]
+            if len(todo):
+                kr, jr = divmod(todo[np.argmin(ratio)], pix_y)
+    if mirror is not None:
+        img[..., mirror[0]] = img[..., mirror[1]]
+        watch.advance(len(mirror[0]) * pix_x)
+    # The pixels left glitched are done as well
+    watch.advance(len(todo))
+    return refs, skipped, todo
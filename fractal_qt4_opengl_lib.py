@@ -56,6 +56,13 @@ void main (void)
     float rt = 0.0;
     float it = 0.0;
     float iter = 0.0;
+#ifdef REJECT_INTERIOR
+    // Points in the main cardioid or the period-2 bulb never escape
+    float xq = xpos - 0.25;
+    float q = xq*xq + ypos*ypos;
+    if (q*(q + xq) <= 0.25*ypos*ypos || (xpos+1.0)*(xpos+1.0) + ypos*ypos <= 0.0625)
+        iter = 1.0;
+#endif
     while(iter < 1.0 && square < max_square)
     {
         rt = (r*r) - (i*i) + xpos;
@@ -75,10 +82,10 @@ class Shader(object):
     #
     # Wrapper to create OpenGL shader programms
     #
-    def __init__(self, vertex_source, fragment_source):
+    def __init__(self, vertex_source, fragment_source, defines=()):
 
-        self.vertexShader = self.compile_vertex_shader(vertex_source)
-        self.fragmentShader = self.compile_fragment_shader(fragment_source)
+        self.vertexShader = self.compile_vertex_shader(self.add_defines(vertex_source, defines))
+        self.fragmentShader = self.compile_fragment_shader(self.add_defines(fragment_source, defines))
         self.shaderProgram = self.link_shader_program(self.vertexShader, self.fragmentShader)
 
     def set_uniform_f(self, name, value):
@@ -94,6 +101,16 @@ class Shader(object):
         else:
             raise TypeError("Only floats are supported so far")
 
+    #
+    # Insert #define lines after the #version line to compile a shader variant
+    #
+    def add_defines(self, source, defines):
+        if not defines:
+            return source
+        version, rest = source.lstrip().split("\n", 1)
+        lines = ["#define %s" % name for name in defines]
+        return "\n".join([version] + lines + [rest])
+
     #
     # Compile a vertex shader from source
     #
@@ -150,6 +167,8 @@ class GLWidget(QGLWidget):
         self.imag = -1.25
         self.h = 2.5
         self.step = 0.005
+        # Skip the iteration for the main cardioid and period-2 bulb
+        self.reject = True
         self.TtC_sum = 0
         self.TtC_count = 0
         self.TtC = 0
@@ -164,7 +183,8 @@ class GLWidget(QGLWidget):
         # Set background color
         gl.glClearColor(0.5,0.5,0.5,0.5)
         # Compile the shader
-        self.shader = Shader(vertex_source=VS, fragment_source=FS)
+        defines = ["REJECT_INTERIOR"] if self.reject else []
+        self.shader = Shader(vertex_source=VS, fragment_source=FS, defines=defines)
         self.shaders_program = self.shader.shaderProgram
         # Setup texture
         self.imageID = self.loadTex("texture.png")
@@ -255,13 +275,11 @@ class GLWidget(QGLWidget):
         return ID
 
     #
-    # Calcualtes precision in digital digits
+    # Calcualtes precision in decimal digits
     #
     def setCoord(self, re_min, im_min,delta):
-        # Calculate precision in decimal digits
-        decimals = 3
-        if abs(delta) <= 1:
-            decimals = round(np.log10(1 / abs(delta))) + 2
+        # Calculate precision in decimal digits, a hundredth of a pixel
+        decimals = max(3, np.ceil(np.log10(self.width / abs(delta))) + 2)
 
         # Round values with calculated precision
         self.real = round(re_min, int(decimals))
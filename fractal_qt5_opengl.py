@@ -9,6 +9,7 @@
 
 import sys
 from fractal_qt5_opengl_lib import GLWidget
+from fractal_qt4_mpl_lib import auto_iter
 # PyQt4 Imports
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -20,7 +21,7 @@ im_min = 0.135
 delta = 0.01
 
 max_betr = 2
-max_iter = 200
+max_iter = 200  # Or "auto" to choose it from the escape rate
 ######################
 
 class AppForm(QMainWindow):
@@ -66,6 +67,7 @@ class AppForm(QMainWindow):
      ### Features ###
      * Zoom in our out by clicking +/- Button
      * Drag with the mouse to move the viewport
+     * Enter auto as Max Iter. to choose it from the escape rate
 
      ### Used Libraries ###
      * PyQt5
@@ -87,11 +89,17 @@ class AppForm(QMainWindow):
         re_min = float(self.textbox_re_min.text())
         im_min = float(self.textbox_im_min.text())
         delta = float(self.textbox_delta.text())
-        max_iter = int(self.textbox_max_iter.text())
+        max_iter = str(self.textbox_max_iter.text()).strip()
 
         # Pass values to GLWidget
         self.glWidget.setCoord(re_min, im_min, delta)
-        self.glWidget.setIter(max_iter)
+        if max_iter == "auto":
+            # Probe the view as rounded by setCoord, the shader uses float32
+            w = self.glWidget
+            max_iter = auto_iter(w.real, w.real + w.w, w.imag, w.imag + w.h, max_betr,
+                                 w.width, "single")
+            self.statusBar().showMessage("Max Iter.: %d" % max_iter, 2000)
+        self.glWidget.setIter(int(max_iter))
         self.glWidget.repaint()
         self.glWidget.setFocus()
 